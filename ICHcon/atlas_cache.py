@@ -0,0 +1,207 @@
+# decompress atlases, templates and tract masks once and share them between
+# processes through memory-mapped .npy files
+import os
+import re
+import json
+import socket
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+ATLAS = ["HCP-MMP", "visual", "somatomotor", "dorsal_attention",
+         "ventral_attention", "limbic", "frontoparietal", "default"]
+
+
+def cache_prefix(img_path):
+    '''
+    Location of the cached copy of `img_path`, without extension.
+    The cache sits in the `ICHMAP_CACHE` directory, by default
+    `~/.cache/ichmap`, and never next to the images, as the atlas, template
+    and tract directories are listed by the pipeline.
+    '''
+    img_path = os.path.abspath(img_path)
+    ID = re.sub(".nii(.gz)?$", "", os.path.basename(img_path))
+    cache_dir = os.environ.get("ICHMAP_CACHE")
+    if cache_dir is None:
+        cache_dir = os.environ.get("XDG_CACHE_HOME",
+                                   os.path.expanduser("~/.cache"))+"/ichmap"
+
+    # different atlas directories may contain images with the same name
+    tag = hashlib.md5(os.path.dirname(img_path).encode()).hexdigest()[:8]
+    return cache_dir+"/"+tag+"_"+ID
+
+
+def affine_to_itk(affine):
+    '''
+    Convert a nifti (RAS) affine to the origin, spacing and direction used by
+    ITK (LPS), so that `read_ants` matches `preprocess.read_ants`.
+    '''
+    spacing = np.sqrt((affine[:3, :3]**2).sum(axis=0))
+    direction = affine[:3, :3]/spacing
+    direction[:2] *= -1
+    origin = affine[:3, 3].copy()
+    origin[:2] *= -1
+    return origin, spacing, direction
+
+
+def tmp_name(path):
+    '''
+    Temporary name to write `path` before renaming it. The cache may sit on a
+    file system shared by several nodes, where process IDs are not unique.
+    '''
+    return "{}.{}.{}".format(path, socket.gethostname(), os.getpid())
+
+
+def _is_stale(img_path, meta_path):
+    if not os.path.exists(meta_path):
+        return True
+    with open(meta_path) as f:
+        meta = json.load(f)
+    stat = os.stat(img_path)
+    return meta["source_size"] != stat.st_size or \
+        meta["source_mtime"] != stat.st_mtime
+
+
+def cache_volume(img_path):
+    '''
+    Decompress `img_path` into `<prefix>.npy` in its on-disk dtype (e.g.
+    uint16 for the parcellations) and write the header information to
+    `<prefix>.json`. Nothing is done if the cache is up to date.
+    The files are written under a temporary name and renamed, so parallel
+    array jobs can safely race to build the same cache.
+
+    Returns:
+        prefix of the cached files
+    '''
+    prefix = cache_prefix(img_path)
+    if not _is_stale(img_path, prefix+".json"):
+        return prefix
+
+    img = nib.load(img_path)
+    # `dataobj` keeps the stored dtype unless a scaling factor is set
+    vol = np.ascontiguousarray(np.asanyarray(img.dataobj))
+    affine = img.affine
+    origin, spacing, direction = affine_to_itk(affine)
+    stat = os.stat(img_path)
+    meta = {"source": os.path.abspath(img_path),
+            "source_size": stat.st_size,
+            "source_mtime": stat.st_mtime,
+            "shape": list(vol.shape),
+            "dtype": vol.dtype.str,
+            "max": vol.max().item(),
+            "affine": affine.tolist(),
+            "origin": origin.tolist(),
+            "spacing": spacing.tolist(),
+            "direction": direction.tolist()}
+
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    tmp = tmp_name(prefix)
+    np.save(tmp+".npy", vol)
+    with open(tmp+".json", "w") as f:
+        json.dump(meta, f)
+    # the volume must be in place before the metadata marks it as valid
+    os.replace(tmp+".npy", prefix+".npy")
+    os.replace(tmp+".json", prefix+".json")
+    return prefix
+
+
+@functools.lru_cache(maxsize=None)
+def load_volume(img_path):
+    '''
+    Read-only memory map of a nifti image in its on-disk dtype.
+    All processes on a node opening the same atlas share one copy in the page
+    cache. Repeated calls within a process return the same array.
+    '''
+    try:
+        prefix = cache_volume(img_path)
+    except OSError:
+        print("cannot write cache for "+img_path+", reading directly")
+        vol = np.asanyarray(nib.load(img_path).dataobj)
+        vol.flags.writeable = False
+        return vol
+    return np.load(prefix+".npy", mmap_mode="r")
+
+
+@functools.lru_cache(maxsize=None)
+def load_meta(img_path):
+    '''
+    Header information of a cached image: `shape`, `dtype`, `max`, `affine`,
+    and the ITK `origin`, `spacing` and `direction`.
+    '''
+    try:
+        prefix = cache_volume(img_path)
+    except OSError:
+        img = nib.load(img_path)
+        origin, spacing, direction = affine_to_itk(img.affine)
+        return {"shape": list(img.shape),
+                "dtype": img.get_data_dtype().str,
+                "max": np.asanyarray(img.dataobj).max().item(),
+                "affine": img.affine.tolist(),
+                "origin": origin.tolist(),
+                "spacing": spacing.tolist(),
+                "direction": direction.tolist()}
+    with open(prefix+".json") as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def load_parcel(mask_path):
+    '''
+    Parcel names of an atlas, read from the csv next to the nifti file
+    '''
+    parcel = pd.read_csv(re.sub(".nii.gz$", ".csv", mask_path),
+                         index_col=[0]).values[:, 0]
+    parcel.flags.writeable = False
+    return parcel
+
+
+def read_ants(img_path):
+    '''
+    Equivalent of `preprocess.read_ants` using the cached volume
+    '''
+    import ants
+    meta = load_meta(img_path)
+    vol = np.array(load_volume(img_path), dtype=np.float32)
+    return ants.from_numpy(vol, origin=tuple(meta["origin"]),
+                           spacing=tuple(meta["spacing"]),
+                           direction=np.array(meta["direction"]))
+
+
+def build_cache(atlas_dir, tract_dir=None):
+    '''
+    Populate the cache for every parcellation, template and tract mask.
+    Running it once before submitting array jobs avoids every job
+    decompressing the same files.
+    Args:
+        `atlas_dir`: path to the directory containing the HCP-MMP atlas
+        `tract_dir`: directory containing the white matter tract masks
+    '''
+    all_paths = [atlas_dir+"/"+i+".nii.gz" for i in ATLAS]
+    template_dir = atlas_dir+"/template/"
+    if os.path.exists(template_dir):
+        all_paths += [template_dir+i for i in sorted(os.listdir(template_dir))
+                      if i.endswith(".nii.gz")]
+    if tract_dir is not None:
+        all_paths += [tract_dir+"/"+i for i in sorted(os.listdir(tract_dir))
+                      if i.endswith(".nii.gz")]
+
+    for i in all_paths:
+        if os.path.exists(i):
+            cache_volume(i)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--atlas_dir', type=str, default="None")
+    parser.add_argument('--tract_dir', type=str, default=None)
+    args = parser.parse_args()
+    if args.atlas_dir == "None":
+        atlas_dir = os.path.dirname(os.path.realpath(__file__)) + \
+            "/../atlas/"
+    else:
+        atlas_dir = args.atlas_dir
+
+    build_cache(atlas_dir, args.tract_dir)
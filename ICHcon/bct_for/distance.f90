@@ -16,18 +16,75 @@ end subroutine init_distance
 
 subroutine distance_wei(a, n, d, bc)
     ! return the shortest distance between all pairs of vertices + betweenness centrality
-    use :: params
     implicit none
     integer, intent(in) :: n
     real(8), dimension(n, n), intent(in) :: a
     real(8), dimension(n, n), intent(out) :: d
     real(8), dimension(n), intent(out) :: bc
 
+    real(8), dimension(n, n) :: a_inv
+    real(8), dimension(n) :: d_row, bc_u
+    integer :: u
+
+    external :: invert, distance_source
+
+    call invert(a, n, a_inv)
+    bc(:) = 0
+    do u = 1, n
+        call distance_source(a_inv, n, u, d_row, bc_u)
+        d(u, :) = d_row
+        bc = bc + bc_u
+    end do
+    bc(:) = bc(:) / dble((n - 1)*(n - 2))
+end subroutine distance_wei
+
+
+subroutine distance_wei_sources(a, n, src, ns, d, bc)
+    ! `distance_wei` restricted to the source nodes in `src`
+    ! Return:
+    ! `d`: ns x n shortest distances from each source
+    ! `bc`: ns x n unnormalized contribution of each source to the
+    ! betweenness centrality, which is the sum of all the rows divided by
+    ! (n - 1)*(n - 2)
+    implicit none
+    integer, intent(in) :: n, ns
+    real(8), dimension(n, n), intent(in) :: a
+    integer, dimension(ns), intent(in) :: src
+    real(8), dimension(ns, n), intent(out) :: d, bc
+
+    real(8), dimension(n, n) :: a_inv
+    real(8), dimension(n) :: d_row, bc_u
+    integer :: i
+
+    external :: invert, distance_source
+
+    call invert(a, n, a_inv)
+    !$OMP PARALLEL DO PRIVATE(d_row, bc_u)
+    do i = 1, ns
+        call distance_source(a_inv, n, src(i), d_row, bc_u)
+        d(i, :) = d_row
+        bc(i, :) = bc_u
+    end do
+    !$OMP END PARALLEL DO
+end subroutine distance_wei_sources
+
+
+subroutine distance_source(a_inv, n, u, d, bc)
+    ! Dijkstra's algorithm from node `u` on the inverted weights `a_inv`
+    ! Return:
+    ! `d`: shortest distance from `u` to every node
+    ! `bc`: contribution of `u` to the (unnormalized) betweenness centrality
+    use :: params
+    implicit none
+    integer, intent(in) :: n, u
+    real(8), dimension(n, n), intent(in) :: a_inv
+    real(8), dimension(n), intent(out) :: d, bc
+
     ! for distance
-    real(8), dimension(n, n) :: a1, a_inv
+    real(8), dimension(n, n) :: a1
     integer(2), dimension(n) :: status_vec
-    integer :: u, i, j, len_v
-    integer, dimension(:), allocatable :: v  ! intermediate nodes 
+    integer :: i, j, len_v
+    integer, dimension(:), allocatable :: v  ! intermediate nodes
     real(8), dimension(n) :: w  ! final nodes
     real(8) :: new_d, min_d
 
@@ -37,93 +94,87 @@ subroutine distance_wei(a, n, d, bc)
     integer, dimension(n, n) :: p
     integer :: q_ind, z
 
-    external :: init_distance, invert
-
-    call invert(a, n, a_inv)
-    call init_distance(n, d)
+    d(:) = inf
+    d(u) = 0
     bc(:) = 0
-    all_node: do u = 1, n
-        ! distance permanence (true is temporary)
-        a1 = a_inv
-        status_vec(:) = 1
-
-        ! initialize v (intermediate node list)
-        len_v = 1
-        if (allocated(v)) then
-            deallocate(v)
-        end if
-        allocate(v(len_v))
-        v(1) = u
-
-        ! initialize arrays for betweenness
-        np(:) = 0
-        np(u) = 1
-        p(:, :) = 0
-        q(:) = 1  ! indices
-        q_ind = n
-
-        whileloop: do
-            intermediate: do j = 1, len_v
-                if (q_ind > 0) then
-                    q(q_ind) = v(j)
-                end if
-                q_ind = q_ind - 1
-
-                status_vec(v(j)) = 0  ! distance u->V is now permanent
-                a1(:, u) = 0  ! no in-edges as already shortest
-                w = reshape(a1(v(j), :), (/n/))
-
-                do i = 1, n
-                    ! among the terminal nodes
-                    if (w(i) /= 0) then
-                        new_d = d(u, v(j)) + a1(v(j), i)
-                        if (d(u, i) > new_d) then
-                            d(u, i) = new_d
-                            np(i) = np(v(j))
-                            p(i, :) = 0
-                            p(i, v(j)) = 1
-                        else if (d(u, i) == new_d) then
-                            np(i) = np(i) + np(v(j)) ! NP(u->w) sum of old and new
-                            p(i, v(j)) = 1  ! v is also predecessor
-                        end if
-                    end if
-                end do
-            end do intermediate
 
-            if (sum(status_vec) == 0) then
-                exit whileloop  ! all nodes reached
+    ! distance permanence (true is temporary)
+    a1 = a_inv
+    status_vec(:) = 1
+
+    ! initialize v (intermediate node list)
+    len_v = 1
+    allocate(v(len_v))
+    v(1) = u
+
+    ! initialize arrays for betweenness
+    np(:) = 0
+    np(u) = 1
+    p(:, :) = 0
+    q(:) = 1  ! indices
+    q_ind = n
+
+    whileloop: do
+        intermediate: do j = 1, len_v
+            if (q_ind > 0) then
+                q(q_ind) = v(j)
             end if
+            q_ind = q_ind - 1
 
-            ! same outcome as np.min(D[u, status_vec])
-            min_d = minval(pack(d(u, :), status_vec == 1))
-            if (min_d == inf) then  ! some nodes cannot be reached
-                exit whileloop
-            end if
+            status_vec(v(j)) = 0  ! distance u->V is now permanent
+            a1(:, u) = 0  ! no in-edges as already shortest
+            w = reshape(a1(v(j), :), (/n/))
 
-            ! same outcome as np.where(d[u, :] == min_d)
-            len_v = count(d(u, :) == min_d)
-            if (len_v == 0) then
-                exit whileloop
-            else
-                deallocate(v)
-                allocate(v(len_v))
-                v = pack([(i, i=1, n)], d(u, :) == min_d)
-            end if
-        end do whileloop
-
-        dp(:) = 0.
-        do j = 1, n -1
-            z = q(j)
-            bc(z) = bc(z) + dp(z)
             do i = 1, n
-                if (p(z, i) /= 0) then
-                    dp(i) = dp(i) + (1 + dp(z)) * np(i) / np(z)
+                ! among the terminal nodes
+                if (w(i) /= 0) then
+                    new_d = d(v(j)) + a1(v(j), i)
+                    if (d(i) > new_d) then
+                        d(i) = new_d
+                        np(i) = np(v(j))
+                        p(i, :) = 0
+                        p(i, v(j)) = 1
+                    else if (d(i) == new_d) then
+                        np(i) = np(i) + np(v(j)) ! NP(u->w) sum of old and new
+                        p(i, v(j)) = 1  ! v is also predecessor
+                    end if
                 end if
             end do
+        end do intermediate
+
+        if (sum(status_vec) == 0) then
+            exit whileloop  ! all nodes reached
+        end if
+
+        ! same outcome as np.min(D[u, status_vec])
+        min_d = minval(pack(d, status_vec == 1))
+        if (min_d == inf) then  ! some nodes cannot be reached
+            exit whileloop
+        end if
+
+        ! same outcome as np.where(d[u, :] == min_d)
+        len_v = count(d == min_d)
+        if (len_v == 0) then
+            exit whileloop
+        else
+            deallocate(v)
+            allocate(v(len_v))
+            v = pack([(i, i=1, n)], d == min_d)
+        end if
+    end do whileloop
+    deallocate(v)
+
+    dp(:) = 0.
+    do j = 1, n -1
+        z = q(j)
+        bc(z) = bc(z) + dp(z)
+        do i = 1, n
+            if (p(z, i) /= 0) then
+                dp(i) = dp(i) + (1 + dp(z)) * np(i) / np(z)
+            end if
         end do
-    end do all_node
-    bc(:) = bc(:) / dble((n - 1)*(n - 2))
-end subroutine distance_wei
+    end do
+end subroutine distance_source
 
 
 subroutine charpath(a, n, lambda, efficiency, ecc, radius, diameter)
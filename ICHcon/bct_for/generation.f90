@@ -11,16 +11,84 @@ subroutine random_choice(k, k_out)
 end subroutine random_choice
 
 
+subroutine rng_seed(seed, stream, state)
+    ! independent xorshift64 stream for every (`seed`, `stream`) pair, so that
+    ! the n-th random network does not depend on which thread generates it
+    implicit none
+    integer, intent(in) :: seed, stream
+    integer(8), intent(out) :: state
+    integer :: i
+    real(8) :: u
+    external :: rng_uniform
+
+    state = ieor(int(seed, 8), int(stream, 8)*2654435761_8)
+    if (state == 0) then
+        state = 88172645463325252_8
+    end if
+    ! discard the first draws to decorrelate neighbouring streams
+    do i = 1, 16
+        call rng_uniform(state, u)
+    end do
+end subroutine rng_seed
+
+
+subroutine rng_uniform(state, u)
+    ! uniform number in [0, 1) from a xorshift64 generator
+    implicit none
+    integer(8), intent(inout) :: state
+    real(8), intent(out) :: u
+
+    state = ieor(state, ishft(state, 13))
+    state = ieor(state, ishft(state, -7))
+    state = ieor(state, ishft(state, 17))
+    u = dble(ishft(state, -11)) * 2d0**(-53)
+end subroutine rng_uniform
+
+
+subroutine rng_choice(state, k, k_out)
+    ! k: maximum integer
+    implicit none
+    integer(8), intent(inout) :: state
+    integer, intent(in) :: k
+    integer, intent(out) :: k_out
+    real(8) :: u
+    external :: rng_uniform
+
+    call rng_uniform(state, u)
+    k_out = floor(u*k) + 1
+end subroutine rng_choice
+
+
 subroutine randmio_und(g, n, itr, r)
     ! equivalent to bct.randmio_und but up to 100 times faster
     implicit none
     integer, intent(in) :: n, itr
     real(8), dimension(n, n), intent(in) :: g
     real(8), dimension(n, n), intent(out) :: r
+    integer(8) :: state
+    integer :: seed
+    real(8) :: u
+    intrinsic :: random_number
+    external :: rng_seed, randmio_und_rng
+
+    call random_number(u)
+    seed = floor(u*huge(seed))
+    call rng_seed(seed, 0, state)
+    call randmio_und_rng(g, n, itr, state, r)
+end subroutine randmio_und
+
+
+subroutine randmio_und_rng(g, n, itr, state, r)
+    ! `randmio_und` drawing from the random stream `state`
+    implicit none
+    integer, intent(in) :: n, itr
+    real(8), dimension(n, n), intent(in) :: g
+    integer(8), intent(inout) :: state
+    real(8), dimension(n, n), intent(out) :: r
     integer :: k, pos_k, max_attempts, itr_all, e1, e2, it, ia, a, b, c, d
     integer, dimension(:), allocatable :: i, j
     real(8) :: u
-    external :: random_choice
+    external :: rng_choice, rng_uniform
 
     ! the following block is equivalent to np.where(np.tril(a))
     k = count(g /= 0)/2
@@ -47,11 +115,11 @@ subroutine randmio_und(g, n, itr, r)
     iteration: do it = 1, itr_all
         attempt: do ia = 1, max_attempts  ! while not rewired
             random: do
-                call random_choice(k, e1)
-                call random_choice(k, e2)
+                call rng_choice(state, k, e1)
+                call rng_choice(state, k, e2)
                 do
                     if (e1 == e2) then
-                        call random_choice(k, e2)
+                        call rng_choice(state, k, e2)
                     else
                         exit
                     end if
@@ -67,7 +135,7 @@ subroutine randmio_und(g, n, itr, r)
                 end if
             end do random
 
-            call random_number(u)
+            call rng_uniform(state, u)
             if (u > .5) then
                 i(e2) = d
                 j(e2) = c  ! flip edge c-d with 50% probability
@@ -94,4 +162,4 @@ subroutine randmio_und(g, n, itr, r)
     end do iteration
     deallocate(i)
     deallocate(j)
-end subroutine randmio_und
+end subroutine randmio_und_rng
@@ -135,3 +135,303 @@ subroutine rich_club_norm(a, n, itr, rc)
     rc_globa = rc_globa / itr
     rc = rc_ori/rc_globa
 end subroutine rich_club_norm
+
+
+subroutine graph_metrics_null(m, n, k, need, globa)
+    ! same as `graph_metrics` but only computes the global metrics in `need`,
+    ! skipping `distance_wei` if no path-based metric is required
+    implicit none
+    integer, intent(in) :: n, k
+    real(8), dimension(n, n), intent(in) :: m
+    logical, dimension(12), intent(in) :: need
+    real(8), dimension(12), intent(out) :: globa
+
+    real(8), dimension(n) :: cent_eig, cent_str, cent_deg, clust, cent_bet, ecc
+    real(8), dimension(n, n) :: d
+    real(8) :: rc, dense, lambd, ge, radius, diam
+    integer :: k_indiv
+    real(8) :: top_perc = 0.12
+    external :: eigenvector_centrality_und, strengths_und, degrees_und
+    external :: clustering_coef_wu, rich_club_wu, density_und
+    external :: find_k, distance_wei
+
+    globa(:) = 0
+    if (need(1)) then
+        call degrees_und(m, n, cent_deg)
+        globa(1) = sum(cent_deg)/dble(n)
+    end if
+    if (need(3)) then
+        call strengths_und(m, n, cent_str)
+        globa(3) = sum(cent_str)/dble(n)
+    end if
+    if (need(5)) then
+        call density_und(m, n, dense)
+        globa(5) = dense
+    end if
+    if (need(2)) then
+        call eigenvector_centrality_und(m, n, cent_eig)
+        globa(2) = sum(cent_eig)/dble(n)
+    end if
+    if (need(4)) then
+        call clustering_coef_wu(m, n, clust)
+        globa(4) = sum(clust)/dble(n)
+    end if
+    if (need(6)) then
+        call rich_club_wu(m, n, k, rc)
+        globa(6) = rc
+    end if
+    if (need(7)) then
+        call find_k(m, n, top_perc, k_indiv)
+        call rich_club_wu(m, n, k_indiv, rc)
+        globa(7) = rc
+    end if
+    if (any(need(8:12))) then
+        call distance_wei(m, n, d, cent_bet)
+        call charpath(d, n, lambd, ge, ecc, radius, diam)
+        globa(8) = sum(cent_bet)/dble(n)
+        globa(9) = ge
+        globa(10) = lambd
+        globa(11) = radius
+        globa(12) = diam
+    end if
+end subroutine graph_metrics_null
+
+
+subroutine normalize_metrics_adaptive(m, n, k, min_itr, max_itr, batch, tol, &
+                                      seed, globa, se, n_itr, norm_noda)
+    ! Args:
+    ! `m`: adjacency matrix (of weight)
+    ! `n`: first dimension of the matrix
+    ! `min_itr`: minimum number of random networks for each metric
+    ! `max_itr`: maximum number of random networks for each metric
+    ! `batch`: number of random networks generated (in parallel) before
+    ! checking convergence
+    ! `tol`: stop drawing random networks for a metric once the standard
+    ! error of its normalized value is below `tol`
+    ! `seed`: the i-th random network always uses the stream (`seed`, i), so
+    ! the result does not depend on the number of threads
+    ! Return:
+    ! `globa`: 12 x 2 matrix, as in `normalize_metrics`
+    ! `se`: standard error of the normalized metrics
+    ! `n_itr`: number of random networks used for each metric
+    ! `norm_noda`: 5 x n matrix
+    use omp_lib
+    implicit none
+    integer, intent(in) :: n, k, min_itr, max_itr, batch, seed
+    real(8), intent(in) :: tol
+    real(8), dimension(n, n), intent(in) :: m
+    real(8), dimension(12, 2), intent(out) :: globa
+    real(8), dimension(12), intent(out) :: se
+    integer, dimension(12), intent(out) :: n_itr
+    real(8), dimension(5, n), intent(out) :: norm_noda
+
+    real(8), dimension(12) :: norm_globa, rand_sum, rand_sumsq
+    real(8), dimension(12, batch) :: rand_globa
+    real(8), dimension(n, n) :: mr
+    logical, dimension(12) :: need
+    integer(8) :: state
+    real(8) :: mu, var
+    integer :: i, j, b, n_drawn, n_batch
+
+    external :: graph_metrics, graph_metrics_null, rng_seed, randmio_und_rng
+
+    call graph_metrics(m, n, k, norm_globa, norm_noda)
+
+    ! degree, total strength and density are preserved by `randmio_und`
+    need(:) = .true.
+    need(1) = .false.
+    need(3) = .false.
+    need(5) = .false.
+
+    rand_sum(:) = 0
+    rand_sumsq(:) = 0
+    n_itr(:) = 0
+    se(:) = 0
+    n_drawn = 0
+
+    do while (any(need) .and. n_drawn < max_itr)
+        n_batch = min(batch, max_itr - n_drawn)
+
+        !$OMP PARALLEL DO PRIVATE(mr, state) SHARED(rand_globa, need)
+        do b = 1, n_batch
+            call rng_seed(seed, n_drawn + b, state)
+            call randmio_und_rng(m, n, 1, state, mr)
+            call graph_metrics_null(mr, n, k, need, rand_globa(:, b))
+        end do
+        !$OMP END PARALLEL DO
+
+        ! accumulate in a fixed order to keep the result reproducible
+        do b = 1, n_batch
+            do j = 1, 12
+                if (need(j)) then
+                    rand_sum(j) = rand_sum(j) + rand_globa(j, b)
+                    rand_sumsq(j) = rand_sumsq(j) + rand_globa(j, b)**2
+                    n_itr(j) = n_itr(j) + 1
+                end if
+            end do
+        end do
+        n_drawn = n_drawn + n_batch
+
+        do j = 1, 12
+            if (need(j) .and. n_itr(j) > 1) then
+                ! delta method for the ratio unnormalized / mean(random)
+                mu = rand_sum(j)/n_itr(j)
+                var = (rand_sumsq(j) - n_itr(j)*mu**2)/(n_itr(j) - 1)
+                var = max(var, 0d0)
+                if (mu /= 0) then
+                    se(j) = abs(norm_globa(j))/mu**2*sqrt(var/n_itr(j))
+                else
+                    se(j) = huge(se(j))
+                end if
+                if (n_itr(j) >= min_itr .and. se(j) <= tol) then
+                    need(j) = .false.
+                end if
+            end if
+        end do
+    end do
+
+    globa(:, 1) = norm_globa(:)
+    do i = 1, 12
+        if (n_itr(i) > 0) then
+            globa(i, 2) = norm_globa(i) / (rand_sum(i)/n_itr(i))
+        else
+            globa(i, 2) = 1
+        end if
+    end do
+end subroutine normalize_metrics_adaptive
+
+
+
+subroutine threshold_rank(rank, w_sorted, n, ne, n_keep, a)
+    ! rebuild a weighted matrix from an edge rank matrix, keeping the
+    ! `n_keep` strongest edges
+    ! `rank`: n x n matrix, 1 is the strongest edge and 0 no edge
+    ! `w_sorted`: edge weights sorted in descending order
+    implicit none
+    integer, intent(in) :: n, ne, n_keep
+    real(8), dimension(n, n), intent(in) :: rank
+    real(8), dimension(ne), intent(in) :: w_sorted
+    real(8), dimension(n, n), intent(out) :: a
+    integer :: i, j, r
+
+    do j = 1, n
+        do i = 1, n
+            r = int(rank(i, j))
+            if (r > 0 .and. r <= n_keep) then
+                a(i, j) = w_sorted(r)
+            else
+                a(i, j) = 0
+            end if
+        end do
+    end do
+end subroutine threshold_rank
+
+
+subroutine sweep_one(a, n, ks, nk, need, globa)
+    ! global metrics of `a` for every rich club level in `ks`
+    ! the k-independent metrics are computed once and copied across `ks`
+    implicit none
+    integer, intent(in) :: n, nk
+    integer, dimension(nk), intent(in) :: ks
+    real(8), dimension(n, n), intent(in) :: a
+    logical, dimension(12), intent(in) :: need
+    real(8), dimension(12, nk), intent(out) :: globa
+
+    logical, dimension(12) :: need_shared
+    real(8), dimension(12) :: shared
+    integer :: ik
+    external :: graph_metrics_null, rich_club_wu
+
+    need_shared = need
+    need_shared(6) = .false.
+    call graph_metrics_null(a, n, ks(1), need_shared, shared)
+    do ik = 1, nk
+        globa(:, ik) = shared(:)
+        if (need(6)) then
+            call rich_club_wu(a, n, ks(ik), globa(6, ik))
+        end if
+    end do
+end subroutine sweep_one
+
+
+subroutine sweep_metrics(rank, w_sorted, n, ne, ks, nk, n_keep, nd, itr, &
+                         seed, globa)
+    ! Graph metrics over several rich club levels and densities
+    ! Args:
+    ! `rank`: n x n edge rank matrix, 1 is the strongest edge and 0 no edge
+    ! `w_sorted`: edge weights sorted in descending order
+    ! `ks`: rich club levels
+    ! `n_keep`: number of edges retained at each density
+    ! `itr`: number of random networks
+    ! `seed`: random seed, see `rng_seed`
+    ! Random network `i` is generated from the full network with the stream
+    ! (`seed`, `i`) and thresholded at every density (randomise then
+    ! threshold). Because edges keep their weights during rewiring, the
+    ! random networks have the same number of edges and total weight as the
+    ! thresholded network. Every (density, network) pair is evaluated in one
+    ! parallel loop, network 0 being the observed one.
+    ! Return:
+    ! `globa`: 12 x 2 x nk x nd, unnormalized and normalized metrics
+    use omp_lib
+    implicit none
+    integer, intent(in) :: n, ne, nk, nd, itr, seed
+    real(8), dimension(n, n), intent(in) :: rank
+    real(8), dimension(ne), intent(in) :: w_sorted
+    integer, dimension(nk), intent(in) :: ks
+    integer, dimension(nd), intent(in) :: n_keep
+    real(8), dimension(12, 2, nk, nd), intent(out) :: globa
+
+    real(8), dimension(12, nk, nd, 0:itr) :: all_globa
+    real(8), dimension(12, nk) :: denom
+    real(8), dimension(n, n) :: a, rank_r
+    logical, dimension(12) :: need, need_null
+    integer(8) :: state
+    integer :: i, id, ik, j
+
+    external :: threshold_rank, sweep_one, rng_seed, randmio_und_rng
+
+    need(:) = .true.
+    ! degree, total strength and density are preserved by `randmio_und`
+    need_null = need
+    need_null(1) = .false.
+    need_null(3) = .false.
+    need_null(5) = .false.
+
+    !$OMP PARALLEL DO COLLAPSE(2) SCHEDULE(dynamic) &
+    !$OMP PRIVATE(a, rank_r, state) SHARED(all_globa)
+    do id = 1, nd
+        do i = 0, itr
+            if (i == 0) then
+                call threshold_rank(rank, w_sorted, n, ne, n_keep(id), a)
+                call sweep_one(a, n, ks, nk, need, all_globa(:, :, id, 0))
+            else
+                ! rewiring is cheap next to the metrics, so each pair draws
+                ! its own copy of network `i`
+                call rng_seed(seed, i, state)
+                call randmio_und_rng(rank, n, 1, state, rank_r)
+                call threshold_rank(rank_r, w_sorted, n, ne, n_keep(id), a)
+                call sweep_one(a, n, ks, nk, need_null, &
+                               all_globa(:, :, id, i))
+            end if
+        end do
+    end do
+    !$OMP END PARALLEL DO
+
+    do id = 1, nd
+        globa(:, 1, :, id) = all_globa(:, :, id, 0)
+        denom(:, :) = 0
+        do i = 1, itr
+            denom = denom + all_globa(:, :, id, i)
+        end do
+        denom = denom / itr
+        do ik = 1, nk
+            do j = 1, 12
+                if (need_null(j)) then
+                    globa(j, 2, ik, id) = globa(j, 1, ik, id) / denom(j, ik)
+                else
+                    globa(j, 2, ik, id) = 1
+                end if
+            end do
+        end do
+    end do
+end subroutine sweep_metrics
@@ -2638,7 +2638,7 @@ static CYTHON_INLINE __Pyx_memviewslice __Pyx_PyObject_to_MemoryviewSlice_d_dc_d
 static CYTHON_INLINE __Pyx_memviewslice __Pyx_PyObject_to_MemoryviewSlice_ds_double(PyObject *, int writable_flag);
 
 /* ObjectToMemviewSlice.proto */
-static CYTHON_INLINE __Pyx_memviewslice __Pyx_PyObject_to_MemoryviewSlice_d_d_dc_unsigned_short(PyObject *, int writable_flag);
+static CYTHON_INLINE __Pyx_memviewslice __Pyx_PyObject_to_MemoryviewSlice_d_d_dc_unsigned_short__const__(PyObject *, int writable_flag);
 
 /* ObjectToMemviewSlice.proto */
 static CYTHON_INLINE __Pyx_memviewslice __Pyx_PyObject_to_MemoryviewSlice_ds_unsigned_short(PyObject *, int writable_flag);
@@ -2827,6 +2827,7 @@ static PyObject *__pyx_unpickle_Enum__set_state(struct __pyx_MemviewEnum_obj *,
 /* #### Code section: typeinfo ### */
 static __Pyx_TypeInfo __Pyx_TypeInfo_double__const__ = { "const double", NULL, sizeof(double const ), { 0 }, 0, 'R', 0, 0 };
 static __Pyx_TypeInfo __Pyx_TypeInfo_double = { "double", NULL, sizeof(double), { 0 }, 0, 'R', 0, 0 };
+static __Pyx_TypeInfo __Pyx_TypeInfo_unsigned_short__const__ = { "const unsigned short", NULL, sizeof(unsigned short const ), { 0 }, 0, __PYX_IS_UNSIGNED(unsigned short const ) ? 'U' : 'I', __PYX_IS_UNSIGNED(unsigned short const ), 0 };
 static __Pyx_TypeInfo __Pyx_TypeInfo_unsigned_short = { "unsigned short", NULL, sizeof(unsigned short), { 0 }, 0, __PYX_IS_UNSIGNED(unsigned short) ? 'U' : 'I', __PYX_IS_UNSIGNED(unsigned short), 0 };
 static __Pyx_TypeInfo __Pyx_TypeInfo_unsigned_long = { "unsigned long", NULL, sizeof(unsigned long), { 0 }, 0, __PYX_IS_UNSIGNED(unsigned long) ? 'U' : 'I', __PYX_IS_UNSIGNED(unsigned long), 0 };
 /* #### Code section: before_global_var ### */
@@ -19618,7 +19619,7 @@ static PyObject *__pyx_pf_8conn_mat_6_to_voxel_coordinates(CYTHON_UNUSED PyObjec
  * 
  * 
  * def connectivity_matrix(list streamlines, double [:, ::1] affine,             # <<<<<<<<<<<<<<
- *                         unsigned short [:, :, ::1] label_volume,
+ *                         const unsigned short [:, :, ::1] label_volume,
  *                         double [:] weighting, int max_lab, int ends):
  */
 
@@ -19761,7 +19762,7 @@ PyObject *__pyx_args, PyObject *__pyx_kwds
     }
     __pyx_v_streamlines = ((PyObject*)values[0]);
     __pyx_v_affine = __Pyx_PyObject_to_MemoryviewSlice_d_dc_double(values[1], PyBUF_WRITABLE); if (unlikely(!__pyx_v_affine.memview)) __PYX_ERR(0, 102, __pyx_L3_error)
-    __pyx_v_label_volume = __Pyx_PyObject_to_MemoryviewSlice_d_d_dc_unsigned_short(values[2], PyBUF_WRITABLE); if (unlikely(!__pyx_v_label_volume.memview)) __PYX_ERR(0, 103, __pyx_L3_error)
+    __pyx_v_label_volume = __Pyx_PyObject_to_MemoryviewSlice_d_d_dc_unsigned_short__const__(values[2], 0); if (unlikely(!__pyx_v_label_volume.memview)) __PYX_ERR(0, 103, __pyx_L3_error)
     __pyx_v_weighting = __Pyx_PyObject_to_MemoryviewSlice_ds_double(values[3], PyBUF_WRITABLE); if (unlikely(!__pyx_v_weighting.memview)) __PYX_ERR(0, 104, __pyx_L3_error)
     __pyx_v_max_lab = __Pyx_PyInt_As_int(values[4]); if (unlikely((__pyx_v_max_lab == (int)-1) && PyErr_Occurred())) __PYX_ERR(0, 104, __pyx_L3_error)
     __pyx_v_ends = __Pyx_PyInt_As_int(values[5]); if (unlikely((__pyx_v_ends == (int)-1) && PyErr_Occurred())) __PYX_ERR(0, 104, __pyx_L3_error)
@@ -20497,7 +20498,7 @@ if (unlikely((__pyx_memoryview_copy_contents(__pyx_t_8, __pyx_t_17, 2, 2, 0) < 0
         __Pyx_RaiseBufferIndexError(__pyx_t_22);
         __PYX_ERR(0, 154, __pyx_L1_error)
       }
-      __pyx_v_one_lab = (*((unsigned short *) ( /* dim=2 */ ((char *) (((unsigned short *) ( /* dim=1 */ (( /* dim=0 */ (__pyx_v_label_volume.data + __pyx_t_27 * __pyx_v_label_volume.strides[0]) ) + __pyx_t_28 * __pyx_v_label_volume.strides[1]) )) + __pyx_t_29)) )));
+      __pyx_v_one_lab = (*((unsigned short const  *) ( /* dim=2 */ ((char *) (((unsigned short const  *) ( /* dim=1 */ (( /* dim=0 */ (__pyx_v_label_volume.data + __pyx_t_27 * __pyx_v_label_volume.strides[0]) ) + __pyx_t_28 * __pyx_v_label_volume.strides[1]) )) + __pyx_t_29)) )));
 
       /* "conn_mat.pyx":155
  *         for k in range(len(entire)):
@@ -20949,7 +20950,7 @@ if (unlikely((__pyx_memoryview_copy_contents(__pyx_t_8, __pyx_t_17, 2, 2, 0) < 0
  * 
  * 
  * def connectivity_matrix(list streamlines, double [:, ::1] affine,             # <<<<<<<<<<<<<<
- *                         unsigned short [:, :, ::1] label_volume,
+ *                         const unsigned short [:, :, ::1] label_volume,
  *                         double [:] weighting, int max_lab, int ends):
  */
 
@@ -20988,7 +20989,7 @@ if (unlikely((__pyx_memoryview_copy_contents(__pyx_t_8, __pyx_t_17, 2, 2, 0) < 0
  * 
  * 
  * def target(list streamlines, double [:, ::1] affine,             # <<<<<<<<<<<<<<
- *            unsigned short [:, :, ::1] target_mask,
+ *            const unsigned short [:, :, ::1] target_mask,
  *            double [:] weighting, double threshold):
  */
 
@@ -21117,7 +21118,7 @@ PyObject *__pyx_args, PyObject *__pyx_kwds
     }
     __pyx_v_streamlines = ((PyObject*)values[0]);
     __pyx_v_affine = __Pyx_PyObject_to_MemoryviewSlice_d_dc_double(values[1], PyBUF_WRITABLE); if (unlikely(!__pyx_v_affine.memview)) __PYX_ERR(0, 185, __pyx_L3_error)
-    __pyx_v_target_mask = __Pyx_PyObject_to_MemoryviewSlice_d_d_dc_unsigned_short(values[2], PyBUF_WRITABLE); if (unlikely(!__pyx_v_target_mask.memview)) __PYX_ERR(0, 186, __pyx_L3_error)
+    __pyx_v_target_mask = __Pyx_PyObject_to_MemoryviewSlice_d_d_dc_unsigned_short__const__(values[2], 0); if (unlikely(!__pyx_v_target_mask.memview)) __PYX_ERR(0, 186, __pyx_L3_error)
     __pyx_v_weighting = __Pyx_PyObject_to_MemoryviewSlice_ds_double(values[3], PyBUF_WRITABLE); if (unlikely(!__pyx_v_weighting.memview)) __PYX_ERR(0, 187, __pyx_L3_error)
     __pyx_v_threshold = __pyx_PyFloat_AsDouble(values[4]); if (unlikely((__pyx_v_threshold == (double)-1) && PyErr_Occurred())) __PYX_ERR(0, 187, __pyx_L3_error)
   }
@@ -21465,7 +21466,7 @@ static PyObject *__pyx_pf_8conn_mat_10target(CYTHON_UNUSED PyObject *__pyx_self,
         __Pyx_RaiseBufferIndexError(__pyx_t_18);
         __PYX_ERR(0, 212, __pyx_L1_error)
       }
-      __pyx_v_one_label = (*((unsigned short *) ( /* dim=2 */ ((char *) (((unsigned short *) ( /* dim=1 */ (( /* dim=0 */ (__pyx_v_target_mask.data + __pyx_t_23 * __pyx_v_target_mask.strides[0]) ) + __pyx_t_24 * __pyx_v_target_mask.strides[1]) )) + __pyx_t_25)) )));
+      __pyx_v_one_label = (*((unsigned short const  *) ( /* dim=2 */ ((char *) (((unsigned short const  *) ( /* dim=1 */ (( /* dim=0 */ (__pyx_v_target_mask.data + __pyx_t_23 * __pyx_v_target_mask.strides[0]) ) + __pyx_t_24 * __pyx_v_target_mask.strides[1]) )) + __pyx_t_25)) )));
 
       /* "conn_mat.pyx":213
  *         for k in range(one_len):
@@ -21591,7 +21592,7 @@ static PyObject *__pyx_pf_8conn_mat_10target(CYTHON_UNUSED PyObject *__pyx_self,
  * 
  * 
  * def target(list streamlines, double [:, ::1] affine,             # <<<<<<<<<<<<<<
- *            unsigned short [:, :, ::1] target_mask,
+ *            const unsigned short [:, :, ::1] target_mask,
  *            double [:] weighting, double threshold):
  */
 
@@ -23520,7 +23521,7 @@ static CYTHON_SMALL_CODE int __Pyx_InitCachedConstants(void) {
  * 
  * 
  * def connectivity_matrix(list streamlines, double [:, ::1] affine,             # <<<<<<<<<<<<<<
- *                         unsigned short [:, :, ::1] label_volume,
+ *                         const unsigned short [:, :, ::1] label_volume,
  *                         double [:] weighting, int max_lab, int ends):
  */
   __pyx_tuple__28 = PyTuple_Pack(28, __pyx_n_s_streamlines, __pyx_n_s_affine, __pyx_n_s_label_volume, __pyx_n_s_weighting, __pyx_n_s_max_lab, __pyx_n_s_ends, __pyx_n_s_sl, __pyx_n_s_a, __pyx_n_s_b, __pyx_n_s_a2, __pyx_n_s_b2, __pyx_n_s_i, __pyx_n_s_j, __pyx_n_s_k, __pyx_n_s_one_lab, __pyx_n_s_label_len, __pyx_n_s_line_len, __pyx_n_s_lin_T, __pyx_n_s_offset, __pyx_n_s_one_line, __pyx_n_s_new_one, __pyx_n_s_entire, __pyx_n_s_labels, __pyx_n_s_label_bool, __pyx_n_s_entireLabels, __pyx_n_s_matrix, __pyx_n_s_nmatrix, __pyx_n_s_mx); if (unlikely(!__pyx_tuple__28)) __PYX_ERR(0, 102, __pyx_L1_error)
@@ -23532,7 +23533,7 @@ static CYTHON_SMALL_CODE int __Pyx_InitCachedConstants(void) {
  * 
  * 
  * def target(list streamlines, double [:, ::1] affine,             # <<<<<<<<<<<<<<
- *            unsigned short [:, :, ::1] target_mask,
+ *            const unsigned short [:, :, ::1] target_mask,
  *            double [:] weighting, double threshold):
  */
   __pyx_tuple__30 = PyTuple_Pack(19, __pyx_n_s_streamlines, __pyx_n_s_affine, __pyx_n_s_target_mask, __pyx_n_s_weighting, __pyx_n_s_threshold, __pyx_n_s_i, __pyx_n_s_k, __pyx_n_s_num_voxel, __pyx_n_s_ROI, __pyx_n_s_one_len, __pyx_n_s_one_label, __pyx_n_s_state, __pyx_n_s_thres, __pyx_n_s_one_str, __pyx_n_s_ind, __pyx_n_s_lin_T, __pyx_n_s_offset, __pyx_n_s_num_fiber, __pyx_n_s_all_length); if (unlikely(!__pyx_tuple__30)) __PYX_ERR(0, 185, __pyx_L1_error)
@@ -24669,7 +24670,7 @@ if (!__Pyx_RefNanny) {
  * 
  * 
  * def connectivity_matrix(list streamlines, double [:, ::1] affine,             # <<<<<<<<<<<<<<
- *                         unsigned short [:, :, ::1] label_volume,
+ *                         const unsigned short [:, :, ::1] label_volume,
  *                         double [:] weighting, int max_lab, int ends):
  */
   __pyx_t_7 = __Pyx_CyFunction_New(&__pyx_mdef_8conn_mat_9connectivity_matrix, 0, __pyx_n_s_connectivity_matrix, NULL, __pyx_n_s_conn_mat, __pyx_d, ((PyObject *)__pyx_codeobj__29)); if (unlikely(!__pyx_t_7)) __PYX_ERR(0, 102, __pyx_L1_error)
@@ -24681,7 +24682,7 @@ if (!__Pyx_RefNanny) {
  * 
  * 
  * def target(list streamlines, double [:, ::1] affine,             # <<<<<<<<<<<<<<
- *            unsigned short [:, :, ::1] target_mask,
+ *            const unsigned short [:, :, ::1] target_mask,
  *            double [:] weighting, double threshold):
  */
   __pyx_t_7 = __Pyx_CyFunction_New(&__pyx_mdef_8conn_mat_11target, 0, __pyx_n_s_target, NULL, __pyx_n_s_conn_mat, __pyx_d, ((PyObject *)__pyx_codeobj__31)); if (unlikely(!__pyx_t_7)) __PYX_ERR(0, 185, __pyx_L1_error)
@@ -30335,7 +30336,7 @@ __pyx_fail:
 }
 
 /* ObjectToMemviewSlice */
-  static CYTHON_INLINE __Pyx_memviewslice __Pyx_PyObject_to_MemoryviewSlice_d_d_dc_unsigned_short(PyObject *obj, int writable_flag) {
+  static CYTHON_INLINE __Pyx_memviewslice __Pyx_PyObject_to_MemoryviewSlice_d_d_dc_unsigned_short__const__(PyObject *obj, int writable_flag) {
     __Pyx_memviewslice result = { 0, 0, { 0 }, { 0 }, { 0 } };
     __Pyx_BufFmt_StackElem stack[1];
     int axes_specs[] = { (__Pyx_MEMVIEW_DIRECT | __Pyx_MEMVIEW_FOLLOW), (__Pyx_MEMVIEW_DIRECT | __Pyx_MEMVIEW_FOLLOW), (__Pyx_MEMVIEW_DIRECT | __Pyx_MEMVIEW_CONTIG) };
@@ -30346,7 +30347,7 @@ __pyx_fail:
     }
     retcode = __Pyx_ValidateAndInit_memviewslice(axes_specs, __Pyx_IS_C_CONTIG,
                                                  (PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) | writable_flag, 3,
-                                                 &__Pyx_TypeInfo_unsigned_short, stack,
+                                                 &__Pyx_TypeInfo_unsigned_short__const__, stack,
                                                  &result, obj);
     if (unlikely(retcode == -1))
         goto __pyx_fail;
@@ -100,7 +100,7 @@ cpdef _to_voxel_coordinates(double [:,::1] streamline,
 
 
 def connectivity_matrix(list streamlines, double [:, ::1] affine, 
-                        unsigned short [:, :, ::1] label_volume, 
+                        const unsigned short [:, :, ::1] label_volume, 
                         double [:] weighting, int max_lab, int ends):
     '''
     This function is rewritten from `dipy.tracking.utils.connectivity_matrix`.
@@ -183,7 +183,7 @@ def connectivity_matrix(list streamlines, double [:, ::1] affine,
 
 
 def target(list streamlines, double [:, ::1] affine, 
-           unsigned short [:, :, ::1] target_mask, 
+           const unsigned short [:, :, ::1] target_mask, 
            double [:] weighting, double threshold):
     '''
     Calculate the number and combind length of the fibers passing through a
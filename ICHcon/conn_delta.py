@@ -0,0 +1,201 @@
+# graph metrics of lesioned connectomes, updated incrementally from the healthy
+# reference rather than recomputed from scratch
+import os
+import numpy as np
+import pandas as pd
+import atlas_cache as AC
+from bct_for import fort as bf
+from conn_metric_for import graph_measures
+from conn_metric_for import node_measures
+
+# reference states kept in memory, keyed by cache path
+resident_states = {}
+
+
+def leading_eigvec(W, x0=None, tol=1e-12, max_iter=1000):
+    '''
+    Leading eigenvector of a non-negative symmetric matrix by power iteration,
+    starting from `x0` (e.g. the eigenvector of the reference network).
+    The matrix is shifted by the identity so that the iteration cannot
+    oscillate between the largest and most negative eigenvalues.
+    Returns None if the iteration does not converge.
+    '''
+    x = np.ones(W.shape[0]) if x0 is None else np.abs(x0)
+    x = x/np.linalg.norm(x)
+    for i in range(max_iter):
+        x_new = W @ x + x
+        norm = np.linalg.norm(x_new)
+        if norm == 0:
+            return None
+        x_new = x_new/norm
+        if np.abs(x_new - x).max() < tol:
+            return x_new
+        x = x_new
+
+
+def _metrics(M, k, d, bc_src, eig):
+    '''
+    Metrics of `M`, as `graph_metrics`, from its distance matrix, the
+    contribution of every source node to the betweenness centrality and the
+    eigenvector centrality
+    '''
+    N = M.shape[0]
+    bc = bc_src.sum(axis=0)/((N - 1)*(N - 2))
+    lambd, ge, ecc, radius, diam = bf.charpath(np.asfortranarray(d))
+
+    deg = bf.degrees_und(M)
+    stren = bf.strengths_und(M)
+    clust = bf.clustering_coef_wu(M)
+    # same single precision constant as `graph_metrics`
+    k_indiv = bf.find_k(M, float(np.float32(0.12)))
+
+    globa = np.array([deg.mean(), eig.mean(), stren.mean(), clust.mean(),
+                      bf.density_und(M), bf.rich_club_wu(M, k),
+                      bf.rich_club_wu(M, k_indiv), bc.mean(), ge, lambd,
+                      radius, diam])
+    noda = np.stack([deg, eig, stren, clust, bc], axis=0)
+    return globa, noda
+
+
+def full_state(M, k=15):
+    '''
+    State of `M` (see `reference_state`) computed from scratch
+    '''
+    N = M.shape[0]
+    d, bc_src = bf.distance_wei_sources(M, np.arange(1, N+1, dtype=np.int32))
+    eig = bf.eigenvector_centrality_und(M)[:, 0]
+    globa, noda = _metrics(M, k, d, bc_src, eig)
+    return {"W": M, "k": k, "globa": globa, "noda": noda, "d": d,
+            "bc_src": bc_src, "eig": eig}
+
+
+def reference_state(W, k=15, cache_path=None):
+    '''
+    Metrics of the reference network, together with what is needed to update
+    them: the distance matrix, the contribution of every source node to the
+    betweenness centrality and the leading eigenvector.
+    Args:
+        `W`: reference connectivity matrix
+        `k`: degree for the rich club coefficient
+        `cache_path`: .npz file to store the state, reused if `W` and `k`
+        have not changed
+    '''
+    M = np.asfortranarray(np.array(W, dtype=float))
+    if cache_path is not None and cache_path in resident_states:
+        state = resident_states[cache_path]
+        if state["k"] == k and np.array_equal(state["W"], M):
+            return state
+
+    if cache_path is not None and os.path.exists(cache_path):
+        state = dict(np.load(cache_path))
+        if state["k"] == k and np.array_equal(state["W"], M):
+            resident_states[cache_path] = state
+            return state
+
+    state = full_state(M, k)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # parallel jobs may compute the same state; write under a temporary
+        # name so that no job reads a partially written file
+        tmp = AC.tmp_name(cache_path)
+        with open(tmp, "wb") as f:
+            np.savez(f, **state)
+        os.replace(tmp, cache_path)
+        resident_states[cache_path] = state
+    return state
+
+
+def affected_sources(state, W):
+    '''
+    Source nodes whose shortest paths may change when the edge weights
+    decrease from `state["W"]` to `W`. The weights are inverted to obtain
+    lengths, so a decrease only matters for the sources whose shortest path
+    tree uses the edge.
+    '''
+    W_ref, d = state["W"], state["d"]
+    row, col = np.nonzero(np.triu(W != W_ref, 1))
+    if len(row) == 0:
+        return np.zeros(W.shape[0], dtype=bool)
+
+    length = 1/W_ref[row, col]
+    d_row, d_col = d[:, row], d[:, col]
+    # a small tolerance only flags more sources, it never misses one
+    on_path = (d_row + length <= d_col*(1 + 1e-12)) | \
+        (d_col + length <= d_row*(1 + 1e-12))
+    return on_path.any(axis=1)
+
+
+def update_state(state, W, max_affected=0.5):
+    '''
+    State of `W`, a copy of the network of `state` with some edge weights
+    decreased (or removed).
+    Shortest paths and betweenness are only recomputed from the affected
+    sources, and the eigenvector centrality is obtained by power iteration
+    from the previous eigenvector. The cheap metrics are recomputed.
+    Args:
+        `state`: output of `reference_state`, `full_state` or `update_state`
+        `W`: connectivity matrix
+        `max_affected`: recompute everything if more than this proportion
+        of source nodes is affected
+    Returns:
+        `state`: state of `W`
+        `num_affected`: number of affected sources, or -1 if everything was
+        recomputed
+    '''
+    M = np.asfortranarray(np.array(W, dtype=float))
+    assert (M <= state["W"]).all(), "edge weights can only decrease"
+    k = int(state["k"])
+
+    affected = affected_sources(state, M)
+    if affected.mean() > max_affected:
+        return full_state(M, k), -1
+
+    d = state["d"].copy()
+    bc_src = state["bc_src"].copy()
+    if affected.any():
+        src = np.where(affected)[0]
+        d[src], bc_src[src] = bf.distance_wei_sources(
+            M, (src+1).astype(np.int32))
+
+    eig = leading_eigvec(M, state["eig"])
+    if eig is None:
+        eig = bf.eigenvector_centrality_und(M)[:, 0]
+    globa, noda = _metrics(M, k, d, bc_src, eig)
+    return {"W": M, "k": k, "globa": globa, "noda": noda, "d": d,
+            "bc_src": bc_src, "eig": eig}, int(affected.sum())
+
+
+def update_metrics(state, W, max_affected=0.5):
+    '''
+    Metrics of `W`, a copy of the reference network with some edge weights
+    decreased (or removed), updated from `state`, see `update_state`
+    Returns:
+        `globa`: 12 global metrics, as `graph_metrics`
+        `noda`: 5 x n node metrics, as `graph_metrics`
+        `num_affected`: see `update_state`
+    '''
+    new_state, num_affected = update_state(state, W, max_affected)
+    return new_state["globa"], new_state["noda"], num_affected
+
+
+def delta_metrics(W_ref, W, k=15, cache_path=None, **kwargs):
+    '''
+    Change in the graph metrics between the reference and lesioned network
+    Args:
+        `W_ref`: reference connectivity matrix (data frame)
+        `W`: lesioned connectivity matrix (data frame), whose weights are at
+        most those of `W_ref`
+        `cache_path`: where to store the reference state
+    Returns:
+        `glob_delta`: reference, lesioned and delta values of global metrics
+        `node_delta`: lesioned minus reference node metrics
+        `num_affected`: see `update_metrics`
+    '''
+    state = reference_state(W_ref.values, k, cache_path)
+    globa, noda, num_affected = update_metrics(state, W.values, **kwargs)
+    glob_delta = pd.DataFrame({"reference": state["globa"],
+                               "lesioned": globa}, index=graph_measures)
+    glob_delta["delta"] = glob_delta["lesioned"] - glob_delta["reference"]
+    node_delta = pd.DataFrame((noda - state["noda"]).T, columns=node_measures,
+                              index=W.index)
+    return glob_delta, node_delta, num_affected
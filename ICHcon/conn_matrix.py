@@ -4,11 +4,13 @@ import os
 import numpy as np
 import pandas as pd
 import nibabel as nib
-from dipy.io.image import load_nifti_data
-from dipy.tracking import utils
-from dipy.io.streamline import load_tractogram
-from dipy.tracking.streamline import length
 from cdipy import conn_mat as CCM
+import atlas_cache as AC
+# dipy is slow to import, so it is imported inside the functions using it
+
+
+# streamlines kept in memory by `preload_streamlines`, keyed by file path
+resident_streamlines = {}
 
 
 def remove_bound(x, dimen, axis=2):
@@ -23,6 +25,8 @@ def get_streamline(tract_path, reference=None, check=False,
     Reference:
     https://dipy.org/documentation/1.5.0/examples_built/streamline_formats/#example-streamline-formats
     '''
+    from dipy.io.streamline import load_tractogram
+    from dipy.tracking.streamline import length
     if reference is None:
         reference = 'same'
     else:
@@ -49,6 +53,32 @@ def get_streamline(tract_path, reference=None, check=False,
     return stream, dimensions, voxel_sizes
 
 
+def load_lesion(lesion_path):
+    '''
+    Lesion mask as an array. `lesion_path` may also be a mask already decoded,
+    e.g. by `prefetch.Prefetcher`, in which case it is returned as is.
+    '''
+    if isinstance(lesion_path, str):
+        from dipy.io.image import load_nifti_data
+        return load_nifti_data(lesion_path)
+    return lesion_path
+
+
+def preload_streamlines(tract_path):
+    '''
+    Keep the streamlines of every tract in `tract_path` in memory, so that
+    `conn_mat_all` no longer reads the trk files. Meant for long-running
+    processes such as `server.py`.
+    '''
+    for i in sorted(os.listdir(tract_path)):
+        one_path = os.path.normpath(tract_path+'/'+i)
+        if one_path not in resident_streamlines:
+            try:
+                resident_streamlines[one_path] = get_streamline(one_path)
+            except Exception:
+                print("cannot load tract " + i)
+
+
 def get_conn_mat(stream, vox, mask_path, lesion_path=None):
     '''
     Obtain connectivity matrix given a tractogram, parcellation atlas, and
@@ -57,7 +87,7 @@ def get_conn_mat(stream, vox, mask_path, lesion_path=None):
         `stream`: list of streamline coordinates
         `vox`: voxel dimension
         `mask_path`: path to parcellation atlas
-        `lesion_path`: path to lesion mask
+        `lesion_path`: path to lesion mask, or the decoded mask
     Return:
         M: N x N numpy ndarray
         nM: N x N numpy ndarray
@@ -66,25 +96,33 @@ def get_conn_mat(stream, vox, mask_path, lesion_path=None):
     affine = np.eye(4, dtype=np.float64, order="C")
 
     if lesion_path is not None:
-        lesion = load_nifti_data(lesion_path)
+        from dipy.tracking import utils
+        lesion = load_lesion(lesion_path)
         stream = list(utils.target(stream, affine, lesion))
         del lesion
 
-    labels = load_nifti_data(mask_path)
-    labels = np.array(labels, dtype=np.uint16, order="C")
+    # memory-mapped atlas shared with the other workers on the node
+    labels = np.asarray(AC.load_volume(mask_path), dtype=np.uint16, order="C")
     M, nM = CCM.connectivity_matrix(stream, affine, labels,
-                                    vox, labels.max(), 0)
+                                    vox, AC.load_meta(mask_path)["max"], 0)
     return np.array(M)[1:, 1:], np.array(nM)[1:, 1:], len(stream)
 
 
 def conn_mat_all(tract_path, mask_path, lesion_path=None):
     all_M, all_nM = [], []
+    if lesion_path is not None:
+        # decode once rather than for every tract
+        lesion_path = load_lesion(lesion_path)
     all_tracks = sorted(os.listdir(tract_path))
     all_T = pd.DataFrame(np.zeros([len(all_tracks), 1]), index=all_tracks,
                          columns=["num"])
     for i in all_tracks:
         try:
-            stream, dimensions, vox = get_streamline(tract_path+'/'+i)
+            one_path = os.path.normpath(tract_path+'/'+i)
+            if one_path in resident_streamlines:
+                stream, dimensions, vox = resident_streamlines[one_path]
+            else:
+                stream, dimensions, vox = get_streamline(one_path)
             M, nM, T = get_conn_mat(stream, vox, mask_path, lesion_path)
             all_T.loc[i] = T
             all_M.append(M)
@@ -99,8 +137,7 @@ def conn_mat_all(tract_path, mask_path, lesion_path=None):
     final_nM = all_nM.sum(axis=2)
 
     # convert to dataframe
-    parcel = pd.read_csv(re.sub(".nii.gz$", ".csv", mask_path),
-                         index_col=[0]).values[:, 0]
+    parcel = AC.load_parcel(mask_path)
     final_M = pd.DataFrame(final_M, index=parcel, columns=parcel)
     final_nM = pd.DataFrame(final_nM, index=parcel, columns=parcel)
     return final_M, final_nM, all_T
@@ -114,7 +151,7 @@ def get_conn_mat_all(tract_path, mask_path, lesion_path=None, ref_path=None):
     Args:
         `tract_path`: directory to list of white matter tracts in .trk format
         `mask_path`: parcellation atlas
-        `lesion_path`: lesion mask
+        `lesion_path`: lesion mask path, or the decoded mask
         `ref_path`: reference directory
     Returns:
         `final_M`: connectivity matrix
@@ -132,10 +169,14 @@ def get_conn_mat_all(tract_path, mask_path, lesion_path=None, ref_path=None):
     if not ref_file or lesion_path is not None:
         final_M, final_nM, tract_num = conn_mat_all(tract_path, mask_path,
                                                     lesion_path)
-        if not ref_file:
-            final_M.to_csv(final_M_path)
-            final_nM.to_csv(final_nM_path)
-            tract_num.to_csv(tract_num_path)
+        # only the matrices of the normal brain are references
+        if lesion_path is None:
+            for df, path in [(final_M, final_M_path),
+                             (final_nM, final_nM_path),
+                             (tract_num, tract_num_path)]:
+                tmp_path = AC.tmp_name(path)
+                df.to_csv(tmp_path)
+                os.replace(tmp_path, path)
 
     elif ref_file and lesion_path is None:
         final_M = pd.read_csv(final_M_path, index_col=[0])
@@ -156,12 +197,13 @@ def get_tract_num(stream, vox, dimen, tract_dir, threshold=0.8):
         percent of it is covered.
     '''
     affine = np.eye(4, dtype=np.float64, order="C")
-    all_tracts = sorted(os.listdir(tract_dir))
+    all_tracts = [i for i in sorted(os.listdir(tract_dir))
+                  if i.endswith(".nii.gz")]
     tract_stats = np.zeros([len(all_tracts), 4])
 
     for index, i in enumerate(all_tracts):
-        tract_mask = load_nifti_data(tract_dir+"/"+i)
-        tract_mask = np.array(tract_mask, dtype=np.uint16, order="C")
+        tract_mask = np.asarray(AC.load_volume(tract_dir+"/"+i),
+                                dtype=np.uint16, order="C")
         num, fiber_len = CCM.target(stream, affine, tract_mask, vox,
                                     threshold)
         ROI = tract_mask.sum()
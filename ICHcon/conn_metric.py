@@ -1,7 +1,11 @@
 import os
+import numpy as np
 import pandas as pd
 from conn_matrix import get_conn_mat_all
+from conn_matrix import load_lesion
 import conn_metric_for as CMF
+import conn_delta as CD
+import atlas_cache as AC
 
 
 def normalize_metrics(W, k, method="fortran", *args, **kwargs):
@@ -9,12 +13,16 @@ def normalize_metrics(W, k, method="fortran", *args, **kwargs):
         return CMF.normalize_metrics_for(W, k, *args, **kwargs)
 
 
-def get_all_metrics(lesion_path, save_M_prefix, atlas_dir, *args, **kwargs):
-    atlas = ["HCP-MMP", "visual", "somatomotor", "dorsal_attention",
-             "ventral_attention", "limbic", "frontoparietal", "default"]
+def sweep_metrics(W, ks, densities=None, method="fortran", *args, **kwargs):
+    if method == "fortran":
+        return CMF.sweep_metrics_for(W, ks, densities, *args, **kwargs)
+
 
+def get_all_metrics(lesion_path, save_M_prefix, atlas_dir, *args, **kwargs):
     all_mets, all_nodes = [], []
-    for i in atlas:
+    # the same lesion is used for every atlas
+    lesion_path = load_lesion(lesion_path)
+    for i in AC.ATLAS:
         parcel_path = atlas_dir+"/"+i+".nii.gz"
         # first, obtain the paths passing through the lesion area
         M, nM, T = get_conn_mat_all(atlas_dir+"/fiber/", parcel_path,
@@ -47,3 +55,118 @@ def get_all_metrics(lesion_path, save_M_prefix, atlas_dir, *args, **kwargs):
     all_mets = pd.concat(all_mets, axis=0)
     all_nodes = pd.concat(all_nodes, axis=0)
     return all_mets, all_nodes
+
+
+def reference_matrix(atlas_dir, atlas, key="count"):
+    '''
+    Connectivity matrix of the normal brain, computed and saved in
+    `atlas_dir`/conn_mat on first use
+    Returns:
+        `ref`: connectivity matrix
+        `ref_path`: path of the saved matrix, without extension
+    '''
+    ref_path = atlas_dir+"/conn_mat/ref_"+atlas+"_"+key
+    if not os.path.exists(ref_path+".csv"):
+        get_conn_mat_all(atlas_dir+"/fiber/", atlas_dir+"/"+atlas+".nii.gz",
+                         ref_path=atlas_dir+"/conn_mat/")
+    return pd.read_csv(ref_path+".csv", index_col=[0]), ref_path
+
+
+def reference_states(atlas_dir, key="count", k=15):
+    '''
+    Load, or compute and cache, the reference state (see
+    `conn_delta.reference_state`) of every atlas used by `get_delta_metrics`
+    '''
+    all_states = {}
+    for i in AC.ATLAS:
+        ref, ref_path = reference_matrix(atlas_dir, i, key)
+        all_states[i] = CD.reference_state(
+            ref.values, k, AC.cache_prefix(ref_path)+"_metrics.npz")
+    return all_states
+
+
+def get_delta_metrics(metric_dir, atlas_dir, key="count", k=15):
+    '''
+    Difference in graph metrics between the healthy reference and the
+    connectome spared by the lesion, i.e. the reference minus the
+    disconnected streamlines saved by `get_all_metrics`.
+    The metrics of the reference are cached. The shortest paths are only
+    updated from the sources affected by the disconnected edges, but in a
+    dense connectome a few edges often lie on the shortest paths of most
+    sources, and the metrics are then fully recomputed (see
+    `conn_delta.update_state`).
+    Returns:
+        `all_mets`: reference, lesioned and delta values of global metrics
+        `all_nodes`: delta of node metrics
+    '''
+    all_mets, all_nodes = [], []
+    for i in AC.ATLAS:
+        ref, ref_path = reference_matrix(atlas_dir, i, key)
+        M = pd.read_csv(metric_dir+"/"+i+"_"+key+".csv", index_col=[0])
+        spared = pd.DataFrame(ref.values - M.values, index=ref.index,
+                              columns=ref.columns)
+        met, node_met, num_affected = CD.delta_metrics(
+            ref, spared, k, AC.cache_prefix(ref_path)+"_metrics.npz")
+        met["atlas"] = i
+        met["measure"] = key
+        met["affected sources"] = num_affected
+        all_mets.append(met)
+
+        node_met["nodes"] = node_met.index
+        node_met = pd.melt(node_met, id_vars="nodes")
+        node_met["atlas"] = i
+        node_met["measure"] = key
+        all_nodes.append(node_met)
+
+    all_mets = pd.concat(all_mets, axis=0)
+    all_nodes = pd.concat(all_nodes, axis=0)
+    return all_mets, all_nodes
+
+
+def sweep_all_metrics(metric_dir, ks=[15], densities=None, key="count",
+                      *args, **kwargs):
+    '''
+    Graph metrics over a range of rich club levels and densities for every
+    atlas, using the matrices saved by `get_all_metrics`.
+    The random networks are drawn from the full matrix and then thresholded,
+    so below density 1 the normalized metrics differ from `normalize_metrics`
+    applied to the thresholded matrix. Each atlas costs about
+    len(`densities`) x (`iteration`+1) full metric evaluations, run in
+    parallel, see `conn_metric_for.sweep_metrics_for`.
+    Args:
+        `metric_dir`: the `metric` folder of a patient
+        `ks`: rich club levels
+        `densities`: proportion of edges to retain
+        `key`: which connectivity matrix to use
+    Returns:
+        data frame with columns `k`, `density`, `metric`, `unnormalized`,
+        `normalized`, `atlas` and `measure`
+    '''
+    all_mets = []
+    for i in AC.ATLAS:
+        W = pd.read_csv(metric_dir+"/"+i+"_"+key+".csv", index_col=[0])
+        one_met = sweep_metrics(W, ks, densities, *args, **kwargs)
+        one_met["atlas"] = i
+        one_met["measure"] = key
+        all_mets.append(one_met)
+    return pd.concat(all_mets, axis=0, ignore_index=True)
+
+
+def density_auc(sweep):
+    '''
+    Area under the curve of each metric across densities (trapezoidal rule)
+    Args:
+        `sweep`: output of `sweep_all_metrics` or `sweep_metrics`
+    '''
+    group = [i for i in ["atlas", "measure", "k", "metric"]
+             if i in sweep.columns]
+    all_auc = []
+    for key, df in sweep.groupby(group, sort=False):
+        df = df.sort_values("density")
+        x = df["density"].values
+        one_auc = dict(zip(group, key))
+        for i in ["unnormalized", "normalized"]:
+            y = df[i].values
+            one_auc[i] = ((y[1:] + y[:-1])/2*np.diff(x)).sum()
+        all_auc.append(one_auc)
+    return pd.DataFrame(all_auc)
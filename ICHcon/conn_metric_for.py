@@ -2,24 +2,135 @@ import numpy as np
 import pandas as pd
 from bct_for import fort as bf
 
+graph_measures = ["degree centrality", "eigen centrality",
+                  "mean strength", "clustering coefficient",
+                  "network density", "rich club coefficient",
+                  "rich club indiv", "betweenness centrality",
+                  "global efficiency",
+                  "characteristic path length", "radius",
+                  "diameter"]
+node_measures = ["degree centrality", "eigen centrality",
+                 "mean strength", "clustering coefficient",
+                 "betweenness centrality"]
 
-def normalize_metrics_for(W, k, iteration=1):
+
+def normalize_metrics_for(W, k, iteration=1, tol=None, max_iteration=200,
+                          batch=8, seed=0):
+    '''
+    Graph metrics normalized by degree-preserving random networks
+    Args:
+        `W`: connectivity matrix
+        `k`: degree for the rich club coefficient
+        `iteration`: number of random networks. If `tol` is supplied, this is
+        the minimum number of random networks per metric.
+        `tol`: keep drawing random networks until the standard error of every
+        normalized metric is below `tol`, or `max_iteration` is reached
+        `batch`: number of random networks drawn between convergence checks
+        `seed`: random seed, only used if `tol` is supplied
+    Returns:
+        `norm_met`: global metrics. If `tol` is supplied, it also contains the
+        standard error of the normalized metric and the number of random
+        networks used.
+        `node_stats`: node metrics
+    '''
     assert type(W) == pd.DataFrame
     M = W.copy().values.astype(float)
     Mf = np.asfortranarray(M)
-    globa, noda = bf.normalize_metrics(Mf, k, iteration)
-    graph_measures = ["degree centrality", "eigen centrality",
-                      "mean strength", "clustering coefficient",
-                      "network density", "rich club coefficient",
-                      "rich club indiv", "betweenness centrality",
-                      "global efficiency",
-                      "characteristic path length", "radius",
-                      "diameter"]
-    node_measures = ["degree centrality", "eigen centrality",
-                     "mean strength", "clustering coefficient",
-                     "betweenness centrality"]
+    if tol is None:
+        globa, noda = bf.normalize_metrics(Mf, k, iteration)
+    else:
+        globa, se, n_itr, noda = bf.normalize_metrics_adaptive(
+            Mf, k, max(iteration, 2), max_iteration, batch, tol, seed)
     norm_met = pd.DataFrame(globa, columns=["unnormalized", "normalized"],
                             index=graph_measures)
+    if tol is not None:
+        norm_met["se"] = se
+        norm_met["iteration"] = n_itr
     node_stats = pd.DataFrame(noda.T, columns=node_measures,
                               index=W.index)
     return norm_met, node_stats
+
+
+def edge_rank(M):
+    '''
+    Rank the edges of a symmetric matrix, 1 being the strongest.
+    Ties are broken by position so that thresholding keeps an exact number of
+    edges.
+    Returns:
+        `rank`: matrix of edge ranks, 0 if there is no edge
+        `w_sorted`: edge weights in descending order
+    '''
+    row, col = np.triu_indices(M.shape[0], 1)
+    keep = M[row, col] != 0
+    row, col = row[keep], col[keep]
+    order = np.argsort(-M[row, col], kind="stable")
+    rank = np.zeros(M.shape)
+    rank[row[order], col[order]] = np.arange(1, len(order)+1)
+    rank = rank + rank.T
+    return rank, M[row[order], col[order]]
+
+
+def sweep_metrics_for(W, ks=[15], densities=None, iteration=1, seed=0):
+    '''
+    Global graph metrics over several rich club levels and densities.
+    Every (density, network) pair, for the thresholded network and each
+    random network, is a full evaluation of the metrics, so the sweep does
+    about len(`densities`) times the work of `normalize_metrics_for` at a
+    single density. The pairs run in one parallel loop, which keeps every
+    thread busy even when `iteration` is smaller than the number of threads.
+    Every metric not depending on `k` is computed once and shared across
+    `ks`.
+    Each random network is drawn from the full network and thresholded at
+    every density (randomise then threshold), with the same random streams
+    as `normalize_metrics_for(W, k, iteration, tol=...)`. The random
+    networks keep the number of edges and the edge weights of each
+    thresholded network, but, below density 1, not its degree sequence, so
+    the normalized metrics differ from `normalize_metrics_for` applied to the
+    thresholded matrix.
+    Args:
+        `W`: connectivity matrix
+        `ks`: rich club levels
+        `densities`: proportion of all possible edges to retain, keeping the
+        strongest ones. If None, the matrix is not thresholded. Densities
+        above that of `W`, or giving the same number of edges as a previous
+        one, are dropped with a warning.
+        `iteration`: number of random networks
+        `seed`: random seed
+    Returns:
+        data frame with columns `k`, `density`, `metric`, `unnormalized` and
+        `normalized`
+    '''
+    assert type(W) == pd.DataFrame
+    M = W.copy().values.astype(float)
+    N = M.shape[0]
+    rank, w_sorted = edge_rank(M)
+    if densities is None:
+        n_keep = [len(w_sorted)]
+    else:
+        n_keep = []
+        for i in densities:
+            one_keep = int(round(i*N*(N-1)/2))
+            if one_keep > len(w_sorted):
+                print("density {} dropped: the network only has density {}"
+                      .format(i, len(w_sorted)/(N*(N-1)/2)))
+            elif one_keep in n_keep:
+                print("density {} dropped: same number of edges as a "
+                      "previous density".format(i))
+            else:
+                n_keep.append(one_keep)
+    globa = bf.sweep_metrics(np.asfortranarray(rank), w_sorted,
+                             np.array(ks, dtype=np.int32),
+                             np.array(n_keep, dtype=np.int32),
+                             iteration, seed)
+
+    all_df = []
+    for id, one_keep in enumerate(n_keep):
+        for ik, one_k in enumerate(ks):
+            one_df = pd.DataFrame(globa[:, :, ik, id],
+                                  columns=["unnormalized", "normalized"])
+            one_df["metric"] = graph_measures
+            one_df["k"] = one_k
+            one_df["density"] = one_keep/(N*(N-1)/2)
+            all_df.append(one_df)
+    all_df = pd.concat(all_df, axis=0, ignore_index=True)
+    return all_df[["k", "density", "metric", "unnormalized", "normalized"]]
@@ -1,20 +1,32 @@
 import re
 import os
-import ants
 import pandas as pd
 import conn_metric as ME
-from preprocess import read_ants
+import atlas_cache as AC
+from conn_matrix import load_lesion
+from prefetch import Prefetcher
+from register import read_case
 from register import register_lesion
 
 
-def lesion_metric(final_dir, atlas_dir):
+def lesion_metric(final_dir, atlas_dir, lesion=None, delta=False):
+    '''
+    `lesion`: registered lesion if already decoded, otherwise it is read from
+    `final_dir`
+    `delta`: also save the change of the graph metrics from the healthy
+    reference (`delta_metrics.csv`, `delta_node_metrics.csv`). This adds the
+    incremental update of every atlas to each patient, and the first patient
+    computes the reference states if they are not cached yet.
+    '''
     all_me, all_nodes = [], []
     if not os.path.exists(final_dir+"/metric"):
         os.mkdir(final_dir+"/metric")
 
     if os.path.exists(final_dir+"/ICH_reg.nii.gz"):
+        if lesion is None:
+            lesion = final_dir+"/ICH_reg.nii.gz"
         metrics, nodes = ME.get_all_metrics(
-            final_dir+"/ICH_reg.nii.gz", final_dir+"/metric/", atlas_dir)
+            lesion, final_dir+"/metric/", atlas_dir)
         all_me.append(metrics)
         all_nodes.append(nodes)
 
@@ -23,9 +35,29 @@ def lesion_metric(final_dir, atlas_dir):
     all_me.to_csv(final_dir+"/graph_metrics.csv")
     all_nodes.to_csv(final_dir+"/node_metrics.csv")
 
+    if not delta:
+        return
+    delta_me, delta_nodes = ME.get_delta_metrics(final_dir+"/metric/",
+                                                 atlas_dir)
+    delta_me.to_csv(final_dir+"/delta_metrics.csv")
+    delta_nodes.to_csv(final_dir+"/delta_node_metrics.csv")
+
+
+def load_case(ct_path, lesion_path, save_dir):
+    '''
+    Decode whatever `lesion_disconn` needs next for one patient: the CT and
+    ICH mask if it is not registered yet, otherwise the registered lesion if
+    the metrics are missing.
+    '''
+    if not os.path.exists(save_dir+"/ICH_reg.nii.gz"):
+        return {"images": read_case(ct_path, lesion_path)}
+    if not os.path.exists(save_dir+"/metric/tract_num.csv"):
+        return {"lesion": load_lesion(save_dir+"/ICH_reg.nii.gz")}
+    return {}
+
 
 def lesion_disconn(ct_dir, mask_dir, save_dir, atlas_dir,
-                   num=1, arrayID=0, **kwargs):
+                   num=1, arrayID=0, prefetch=2, delta=False, **kwargs):
     '''
     Lesion connectome
 
@@ -37,6 +69,10 @@ def lesion_disconn(ct_dir, mask_dir, save_dir, atlas_dir,
         `num`: number of jobs to submit in parallel
         `arrayID`: job ID. The `num` and `arrayID` arguments are only suitable
         in HPC setting.
+        `prefetch`: number of patients decoded in the background while the
+        current one is processed
+        `delta`: also save the change of the graph metrics from the healthy
+        reference, see `lesion_metric`
 
     Returns:
         the folder structure in `save_dir`:
@@ -52,29 +88,39 @@ def lesion_disconn(ct_dir, mask_dir, save_dir, atlas_dir,
         ---node_metrics.csv
         ---metric/
     '''
+    import ants
     if not os.path.exists(save_dir):
         os.mkdir(save_dir)
 
-    MNI = read_ants(atlas_dir+"/template/MNI_header.nii.gz")
+    MNI = AC.read_ants(atlas_dir+"/template/MNI_header.nii.gz")
     MNI_mask = ants.threshold_image(MNI, low_thresh=0.5, binary=True)
 
+    all_ID = []
     for index, i in enumerate(os.listdir(ct_dir)):
         if index % num == arrayID:
             ID = re.sub(".nii.gz", "", i)
             if not os.path.exists(save_dir+"/"+ID):
                 os.mkdir(save_dir+"/"+ID)
+            all_ID.append(i)
+
+    def loader(i):
+        ID = re.sub(".nii.gz", "", i)
+        return load_case(ct_dir+"/"+i, mask_dir+"/"+i, save_dir+"/"+ID)
 
-            lesion_path = mask_dir+"/"+i
-            ct_path = ct_dir+"/"+i
-            save_path = save_dir+"/"+ID+"/ICH_reg.nii.gz"
+    for i, case in Prefetcher(all_ID, loader, depth=prefetch):
+        ID = re.sub(".nii.gz", "", i)
+        lesion_path = mask_dir+"/"+i
+        ct_path = ct_dir+"/"+i
+        save_path = save_dir+"/"+ID+"/ICH_reg.nii.gz"
 
-            if not os.path.exists(save_path):
-                register_lesion(ct_path, lesion_path, MNI, MNI_mask,
-                                save_path, **kwargs)
+        if not os.path.exists(save_path):
+            register_lesion(ct_path, lesion_path, MNI, MNI_mask,
+                            save_path, images=case.get("images"), **kwargs)
 
-            if os.path.exists(save_path):
-                if not os.path.exists(save_dir+"/"+ID+"/metric/tract_num.csv"):
-                    lesion_metric(save_dir+"/"+ID, atlas_dir)
+        if os.path.exists(save_path):
+            if not os.path.exists(save_dir+"/"+ID+"/metric/tract_num.csv"):
+                lesion_metric(save_dir+"/"+ID, atlas_dir, case.get("lesion"),
+                              delta)
 
 
 if __name__ == "__main__":
@@ -87,6 +133,8 @@ if __name__ == "__main__":
 
     parser.add_argument("--num", type=int, default=1)
     parser.add_argument("--arrayID", type=int, default=0)
+    parser.add_argument("--prefetch", type=int, default=2)
+    parser.add_argument("--delta", action="store_true")
     args = parser.parse_args()
     if args.atlas_dir == "None":
         atlas_dir = os.path.dirname(os.path.realpath(__file__)) + \
@@ -96,4 +144,4 @@ if __name__ == "__main__":
 
     lesion_disconn(
         args.ct_dir, args.mask_dir, args.save_dir,
-        atlas_dir, args.num, args.arrayID)
+        atlas_dir, args.num, args.arrayID, args.prefetch, args.delta)
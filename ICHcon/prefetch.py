@@ -0,0 +1,78 @@
+# decode the next patients' images in the background
+import gzip
+import threading
+import queue
+import nibabel as nib
+
+
+class Prefetcher:
+    '''
+    Iterate over `items`, yielding `(item, loader(item))` in order while the
+    next `depth` items are loaded in a background thread.
+    Reading and gunzipping NIfTI files (nibabel, SimpleITK) mostly runs
+    outside the GIL, so it overlaps with registration or the connectome
+    kernels of the current patient. An item is only loaded once fewer than
+    `depth` loaded items are waiting, so at most `depth` patients are held in
+    memory in addition to the one being processed.
+    If `loader` raises, the exception is raised again when its item is
+    reached.
+
+    Example:
+        for ct_path, img in Prefetcher(all_paths, read_nifti):
+            ...
+    '''
+    def __init__(self, items, loader, depth=2):
+        self.items = list(items)
+        self.loader = loader
+        self.depth = depth
+
+    def _work(self, out, stop, slots):
+        for i in self.items:
+            # a slot is freed when the consumer takes an item, so at most
+            # `depth` loaded items wait in `out`
+            while not slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            if stop.is_set():
+                break
+            try:
+                out.put((i, self.loader(i), None))
+            except Exception as err:
+                out.put((i, None, err))
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for i in self.items:
+                yield i, self.loader(i)
+            return
+
+        out = queue.Queue()
+        stop = threading.Event()
+        slots = threading.Semaphore(self.depth)
+        worker = threading.Thread(target=self._work, args=(out, stop, slots),
+                                  daemon=True)
+        worker.start()
+        try:
+            for _ in range(len(self.items)):
+                i, data, err = out.get()
+                slots.release()
+                if err is not None:
+                    raise err
+                yield i, data
+        finally:
+            # also reached if the loop is left early
+            stop.set()
+            worker.join()
+
+
+def read_nifti(img_path):
+    '''
+    Decompress a NIfTI file into memory. The returned image keeps the header
+    (including intensity scaling) untouched, but reading its data no longer
+    touches the file system or gunzips it again.
+    '''
+    with open(img_path, "rb") as f:
+        content = f.read()
+    if img_path.endswith(".gz"):
+        content = gzip.decompress(content)
+    return nib.Nifti1Image.from_bytes(content)
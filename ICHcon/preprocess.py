@@ -1,16 +1,15 @@
 import os
 import re
+import shutil
+import tempfile
 import subprocess
 import numpy as np
-import ants
-import SimpleITK as sitk
 import nibabel as nib
-import skimage
-from scipy import ndimage
-from fsl.data.image import Image
-from fsl.utils.image.resample import resample
-from fsl.wrappers import bet
-from fsl.wrappers import fslmaths
+import atlas_cache as AC
+from prefetch import Prefetcher
+from prefetch import read_nifti
+# ants, SimpleITK, skimage and fsl take seconds to import, so they are only
+# imported inside the functions using them
 
 
 def bash_in_python(cmd):
@@ -32,6 +31,8 @@ def unix_cmd(cmd):
 
 
 def read_ants(img_path):
+    import ants
+    import SimpleITK as sitk
     img = sitk.ReadImage(img_path)
     direction = np.array(img.GetDirection()).reshape(3, 3)
     spacing = img.GetSpacing()
@@ -43,6 +44,17 @@ def read_ants(img_path):
     return img_ant
 
 
+def nib_to_ants(img):
+    '''
+    Equivalent of `read_ants` for an image already decoded by nibabel (e.g.
+    `prefetch.read_nifti`), without reading the file again
+    '''
+    import ants
+    origin, spacing, direction = AC.affine_to_itk(img.affine)
+    return ants.from_numpy(img.get_fdata(), origin=tuple(origin),
+                           spacing=tuple(spacing), direction=direction)
+
+
 def select_depth(D, depths):
     if D > depths:
         start_depth = (D - depths)//2
@@ -60,7 +72,15 @@ def sel_central(img, depths):
 
 
 def skull_strip(img_path, save_path, window=[0, 100], sigma=0):
-    ori_ob = nib.load(img_path)
+    '''
+    `img_path` may also be a nibabel image already loaded in memory
+    '''
+    import skimage
+    from scipy import ndimage
+    if isinstance(img_path, str):
+        ori_ob = nib.load(img_path)
+    else:
+        ori_ob = img_path
     ori_img = ori_ob.get_fdata()
     if len(ori_img.shape) == 4:
         ori_img = ori_img[..., 0]
@@ -97,6 +117,8 @@ def skull_strip(img_path, save_path, window=[0, 100], sigma=0):
 
 
 def preprocess_ct(img_path, out_path, target_res=5):
+    from fsl.data.image import Image
+    from fsl.utils.image.resample import resample
     img = Image(img_path)
     res = img.pixdim[2]
 
@@ -173,6 +195,8 @@ def brain(img_path, save_path):
     Output:
     - brain_image: nifti object, extracted brain
     """
+    from fsl.wrappers import bet
+    from fsl.wrappers import fslmaths
     image = nib.load(img_path)
     affine = image.affine
     header = image.header
@@ -204,22 +228,141 @@ def brain(img_path, save_path):
     image.to_filename(save_path)
 
 
-def preprocess_imgs(ct_path, save_path, skullstrip=True, preprocess=True):
-    if not os.path.exists(save_path):
-        ID = ''.join([str(i) for i in np.random.choice(9, 10)])
-        tmp_path = re.sub(".nii.gz", ID+".nii.gz", save_path)
+def prepare_imgs(ct_path, tmp_path, ct_img=None):
+    '''
+    In-house skull stripping and resampling, i.e. everything before SynthStrip
+    Args:
+        `tmp_path`: where to save the intermediate image
+        `ct_img`: the CT at `ct_path` if already decoded
+        (`prefetch.read_nifti`)
+    Returns:
+        True if `tmp_path` was written, False if the scan is skipped
+    '''
+    # only the header is needed, the data are not read again
+    header = (nib.load(ct_path) if ct_img is None else ct_img).header
+    res = header.get_zooms()[2]
+    abort = header.get_data_shape()[2] < 50 and res < 1
+
+    if not abort:
+        skull_strip(ct_path if ct_img is None else ct_img, tmp_path)
+        preprocess_ct(tmp_path, tmp_path)
+    return os.path.exists(tmp_path)
 
-        img = Image(ct_path)
-        res = img.pixdim[2]
-        abort = img.shape[2] < 50 and res < 1
 
-        if not abort:
-            skull_strip(ct_path, tmp_path)
-            preprocess_ct(tmp_path, tmp_path)
-            if os.path.exists(tmp_path):
+class SynthStrip:
+    '''
+    A long-running SynthStrip process (`synthstrip_worker.py`), so that
+    PyTorch and the model are loaded once for all the images of a job rather
+    than by every `mri_synthstrip` call.
+    The worker runs with the interpreter of the installed `mri_synthstrip`
+    script, which has PyTorch and surfa. If the script is not a Python
+    script (e.g. a shell wrapper), or the worker cannot start or dies,
+    `mri_synthstrip` is called for every image instead.
+    Args:
+        `threads`: number of PyTorch threads
+
+    Example:
+        with SynthStrip(threads=4) as stripper:
+            stripper.strip(in_path, save_path)
+    '''
+    def __init__(self, threads=None):
+        self.proc = None
+        script = shutil.which("mri_synthstrip")
+        if script is None:
+            print("mri_synthstrip is not in the PATH")
+            return
+        try:
+            with open(script) as f:
+                first_line = f.readline()
+        except (OSError, UnicodeDecodeError):
+            first_line = ""
+        python = first_line[2:].split()
+        if not first_line.startswith("#!") or \
+                not any("python" in os.path.basename(i) for i in python):
+            print("mri_synthstrip is not a Python script, it is called for "
+                  "every image")
+            return
+
+        cmd = python + [os.path.dirname(os.path.realpath(__file__)) +
+                        "/synthstrip_worker.py", script]
+        if threads is not None:
+            cmd += ["--threads", str(threads)]
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, text=True)
+        except OSError as err:
+            print("cannot start the SynthStrip process: "+str(err))
+
+    def strip(self, in_path, save_path):
+        '''
+        Equivalent of `mri_synthstrip -i in_path -o save_path`
+        Returns:
+            True if successful
+        '''
+        if self.proc is not None:
+            try:
+                self.proc.stdin.write(in_path+"\t"+save_path+"\n")
+                self.proc.stdin.flush()
+                reply = self.proc.stdout.readline()
+            except BrokenPipeError:
+                reply = ""
+            if reply != "":
+                if reply != "ok\n":
+                    print(reply.rstrip("\n"))
+                return reply == "ok\n"
+            print("the SynthStrip process exited with code " +
+                  str(self.proc.wait()) +
+                  ", mri_synthstrip is called for every image")
+            self.close()
+        bash_in_python("mri_synthstrip -i {} -o {}".format(in_path,
+                                                           save_path))
+        return os.path.exists(save_path)
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            # the process already exited
+            pass
+        self.proc.wait()
+        self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def preprocess_imgs(ct_path, save_path, skullstrip=True, preprocess=True,
+                    ct_img=None, stripper=None):
+    '''
+    `ct_img`: the CT at `ct_path` if already decoded (`prefetch.read_nifti`)
+    `stripper`: a running `SynthStrip`. If None, `mri_synthstrip` is called
+    for this image only.
+    The intermediate images are kept in a temporary folder next to the output
+    folder, and the result is only moved to `save_path` once complete, so
+    other jobs listing the output folder never see partial files.
+    '''
+    if os.path.exists(save_path):
+        return
+    tmp_dir = tempfile.mkdtemp(
+        prefix=".preprocess_",
+        dir=os.path.dirname(os.path.dirname(os.path.abspath(save_path))))
+    try:
+        tmp_path, out_path = tmp_dir+"/prepared.nii.gz", tmp_dir+"/out.nii.gz"
+        if prepare_imgs(ct_path, tmp_path, ct_img):
+            if stripper is None:
                 bash_in_python("mri_synthstrip -i {}".format(tmp_path) +
-                               " -o {}".format(save_path))
-            os.remove(tmp_path)
+                               " -o {}".format(out_path))
+            elif not stripper.strip(tmp_path, out_path):
+                print("SynthStrip failed for "+ct_path)
+            if os.path.exists(out_path):
+                os.replace(out_path, save_path)
+    finally:
+        shutil.rmtree(tmp_dir)
 
 
 if __name__ == "__main__":
@@ -230,8 +373,18 @@ if __name__ == "__main__":
 
     parser.add_argument("--num", type=int, default=1)
     parser.add_argument("--arrayID", type=int, default=0)
+    parser.add_argument("--prefetch", type=int, default=2)
+    parser.add_argument("--strip_threads", type=int, default=None)
     args = parser.parse_args()
 
-    for index, i in enumerate(sorted(os.listdir(args.ct_dir))):
-        if index % args.num == args.arrayID:
-            preprocess_imgs(args.ct_dir+"/"+i, args.save_dir+"/"+i)
+    all_ID = [i for index, i in enumerate(sorted(os.listdir(args.ct_dir)))
+              if index % args.num == args.arrayID and
+              not os.path.exists(args.save_dir+"/"+i)]
+    # one SynthStrip model for the whole job; every case is saved as soon as
+    # it is done
+    with SynthStrip(args.strip_threads) as stripper:
+        for i, ct_img in Prefetcher(all_ID,
+                                    lambda x: read_nifti(args.ct_dir+"/"+x),
+                                    depth=args.prefetch):
+            preprocess_imgs(args.ct_dir+"/"+i, args.save_dir+"/"+i,
+                            ct_img=ct_img, stripper=stripper)
@@ -2,15 +2,32 @@ import os
 import shutil
 import numpy as np
 import nibabel as nib
-import ants
-from fsl.wrappers import fslmaths
+import atlas_cache as AC
+from prefetch import Prefetcher
+from prefetch import read_nifti
 from preprocess import read_ants
+from preprocess import nib_to_ants
 from preprocess import sel_central
 from preprocess import select_depth
 from preprocess import bash_in_python
 
 
-def register_lesion(ct_path, lesion_path, MNI, MNI_mask, save_path):
+def read_case(ct_path, lesion_path):
+    '''
+    Decode the CT and ICH mask needed by `register_lesion`.
+    Returns None if the CT does not exist.
+    '''
+    if not os.path.exists(ct_path):
+        return None
+    # the CT is only decompressed once
+    CT_nib = read_nifti(ct_path)
+    return {"CT_nib": CT_nib,
+            "CT": nib_to_ants(CT_nib),
+            "lesion": read_ants(lesion_path)}
+
+
+def register_lesion(ct_path, lesion_path, MNI, MNI_mask, save_path,
+                    images=None):
     '''
     Method:
     1. skullstripping (optional)
@@ -24,15 +41,20 @@ def register_lesion(ct_path, lesion_path, MNI, MNI_mask, save_path):
         `MNI_mask`: MNI brain mask path
         `save_path`: where to save the registered lesion
         `sel_depth`: only select the central slices
+        `images`: output of `read_case` if the images were already decoded
     '''
+    import ants
+    from fsl.wrappers import fslmaths
     ID = ''.join([str(i) for i in np.random.choice(9, 10)])
     tmp_dir = os.path.dirname(save_path)+"/"+ID
     os.mkdir(tmp_dir)
 
-    if os.path.exists(ct_path):
-        CT_nib = nib.load(ct_path)
-        CT = read_ants(ct_path)
-        lesion = read_ants(lesion_path)
+    if images is None:
+        images = read_case(ct_path, lesion_path)
+
+    if images is not None:
+        CT_nib, CT = images["CT_nib"], images["CT"]
+        lesion = images["lesion"]
 
         if lesion.shape[2] != CT.shape[2]:
             sel_depth = lesion.shape[2]
@@ -79,16 +101,22 @@ def register_lesion(ct_path, lesion_path, MNI, MNI_mask, save_path):
 
 
 def pipeline(ct_dir, mask_dir, save_dir, atlas_dir,
-             num=1, arrayID=0, **kwargs):
+             num=1, arrayID=0, prefetch=2, **kwargs):
+    '''
+    Args:
+        `prefetch`: number of patients decoded in advance while the current
+        one is being registered
+    '''
     MNI_path = atlas_dir+"/template/MNI.nii.gz"
     MNI_mask_path = atlas_dir+"/template/MNI_mask.nii.gz"
 
-    MNI = ants.image_read(MNI_path)
-    MNI_mask = ants.image_read(MNI_mask_path)
+    MNI = AC.read_ants(MNI_path)
+    MNI_mask = AC.read_ants(MNI_mask_path)
 
     if not os.path.exists(save_dir):
         os.mkdir(save_dir)
 
+    all_cases = []
     for index, i in enumerate(os.listdir(ct_dir)):
         if index % num == arrayID:
             ct_path = ct_dir+"/"+i
@@ -97,8 +125,13 @@ def pipeline(ct_dir, mask_dir, save_dir, atlas_dir,
 
             if os.path.exists(lesion_path) and os.path.exists(ct_path):
                 if not os.path.exists(save_path):
-                    register_lesion(ct_path, lesion_path, MNI, MNI_mask,
-                                    save_path, **kwargs)
+                    all_cases.append((ct_path, lesion_path, save_path))
+
+    for case, images in Prefetcher(all_cases, lambda x: read_case(*x[:2]),
+                                   depth=prefetch):
+        ct_path, lesion_path, save_path = case
+        register_lesion(ct_path, lesion_path, MNI, MNI_mask, save_path,
+                        images=images, **kwargs)
 
 
 if __name__ == "__main__":
@@ -111,6 +144,7 @@ if __name__ == "__main__":
 
     parser.add_argument("--num", type=int, default=1)
     parser.add_argument("--arrayID", type=int, default=0)
+    parser.add_argument("--prefetch", type=int, default=2)
     args = parser.parse_args()
 
     if args.atlas_dir == "None":
@@ -120,4 +154,4 @@ if __name__ == "__main__":
         atlas_dir = args.atlas_dir
 
     pipeline(args.ct_dir, args.mask_dir, args.save_dir,
-             atlas_dir, args.num, args.arrayID)
+             atlas_dir, args.num, args.arrayID, args.prefetch)
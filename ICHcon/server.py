@@ -0,0 +1,310 @@
+# long-running disconnectome service keeping the atlases and tractograms in
+# memory
+import os
+import json
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+import atlas_cache as AC
+import conn_matrix as CM
+import conn_metric as ME
+
+# upper bounds (in seconds) of the latency histogram
+BUCKETS = [0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, float("inf")]
+
+# state of each worker process, filled by `init_worker`
+worker_state = {}
+
+
+def warm_up(atlas_dir):
+    '''
+    Load everything shared by all requests. Called in the parent before the
+    worker processes are forked, so the streamlines and healthy reference
+    matrices are shared between the workers.
+    The atlases and templates are memory-mapped through `atlas_cache`.
+    '''
+    AC.build_cache(atlas_dir)
+    CM.preload_streamlines(atlas_dir+"/fiber/")
+    # the reference connectomes are built first, without a lesion, as the
+    # reference states below are computed from them
+    ref = {}
+    for i in AC.ATLAS:
+        AC.load_volume(atlas_dir+"/"+i+".nii.gz")
+        AC.load_parcel(atlas_dir+"/"+i+".nii.gz")
+        ref[i], _, _ = CM.get_conn_mat_all(
+            atlas_dir+"/fiber/", atlas_dir+"/"+i+".nii.gz",
+            ref_path=atlas_dir+"/conn_mat/")
+    # the reference states of the delta metrics are computed with OpenMP,
+    # which cannot be used in forked children once the parent has started
+    # its threads; compute any missing one in a separate process, and only
+    # read the cached states here
+    with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn")) as pool:
+        pool.submit(cache_reference_states, atlas_dir).result()
+    ME.reference_states(atlas_dir)
+    return ref
+
+
+def cache_reference_states(atlas_dir):
+    ME.reference_states(atlas_dir)
+
+
+def init_worker(atlas_dir, ref):
+    '''
+    ANTs is not fork-safe once its thread pool has started, so the template is
+    read in every worker instead of in the parent
+    '''
+    import ants
+    MNI = AC.read_ants(atlas_dir+"/template/MNI_header.nii.gz")
+    worker_state["atlas_dir"] = atlas_dir
+    worker_state["MNI"] = MNI
+    worker_state["MNI_mask"] = ants.threshold_image(MNI, low_thresh=0.5,
+                                                    binary=True)
+    worker_state["ref"] = ref
+
+
+def disconnectome(query):
+    '''
+    Compute the disconnectome of one lesion, in a worker process
+    Args:
+        `query`: dictionary containing either `reg_lesion`, the path to a
+        lesion registered to the MNI template (`ICH_reg.nii.gz`), or `ct` and
+        `mask`, the native CT and ICH mask. If `save_dir` is supplied, the
+        output is saved there with the same structure as `lesion.py`.
+    Returns:
+        dictionary of graph metrics, node metrics and connectivity matrices
+    '''
+    from lesion import lesion_metric
+    from register import register_lesion
+    atlas_dir = worker_state["atlas_dir"]
+
+    save_dir = query.get("save_dir")
+    tmp_dir = None
+    if save_dir is None:
+        tmp_dir = tempfile.mkdtemp()
+        save_dir = tmp_dir
+    os.makedirs(save_dir, exist_ok=True)
+
+    try:
+        reg_path = save_dir+"/ICH_reg.nii.gz"
+        if "reg_lesion" in query:
+            if not os.path.exists(reg_path) or \
+                    not os.path.samefile(query["reg_lesion"], reg_path):
+                shutil.copy(query["reg_lesion"], reg_path)
+        else:
+            register_lesion(query["ct"], query["mask"], worker_state["MNI"],
+                            worker_state["MNI_mask"], reg_path)
+        if not os.path.exists(reg_path):
+            raise ValueError("registration failed")
+
+        lesion_metric(save_dir, atlas_dir, delta=True)
+        graph = pd.read_csv(save_dir+"/graph_metrics.csv", index_col=[0])
+        nodes = pd.read_csv(save_dir+"/node_metrics.csv", index_col=[0])
+        delta = pd.read_csv(save_dir+"/delta_metrics.csv", index_col=[0])
+        out = {"graph_metrics": graph.reset_index().to_dict("records"),
+               "node_metrics": nodes.to_dict("records"),
+               "delta_metrics": delta.reset_index().to_dict("records"),
+               "matrices": {},
+               "disconnected_fraction": {}}
+        for i in AC.ATLAS:
+            M = pd.read_csv(save_dir+"/metric/"+i+"_count.csv",
+                            index_col=[0])
+            out["matrices"][i] = {"parcel": list(M.index),
+                                  "count": M.values.tolist()}
+            ref = worker_state["ref"][i].values.sum()
+            out["disconnected_fraction"][i] = M.values.sum()/ref
+        return out
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+class Latency:
+    '''
+    Thread-safe histogram of request latencies
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = np.zeros(len(BUCKETS), dtype=int)
+        self.total = 0.
+        self.errors = 0
+
+    def add(self, seconds, error=False):
+        with self.lock:
+            self.counts[np.searchsorted(BUCKETS, seconds)] += 1
+            self.total += seconds
+            self.errors += int(error)
+
+    def summary(self):
+        with self.lock:
+            num = int(self.counts.sum())
+            return {"buckets": [str(i) for i in BUCKETS],
+                    "counts": self.counts.tolist(),
+                    "cumulative": self.counts.cumsum().tolist(),
+                    "num": num,
+                    "errors": self.errors,
+                    "mean": self.total/num if num > 0 else None}
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    POST /disconnectome  json query, see `disconnectome`
+    GET  /latency        latency histogram of /disconnectome in seconds
+    GET  /health         liveness check
+    '''
+    def send_json(self, code, out):
+        body = json.dumps(out).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def do_GET(self):
+        if self.path == "/latency":
+            self.send_json(200, self.server.latency.summary())
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": "unknown endpoint"})
+
+    def do_POST(self):
+        if self.path != "/disconnectome":
+            self.send_json(404, {"error": "unknown endpoint"})
+            return
+
+        start = time.time()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            query = json.loads(self.rfile.read(length))
+            if not isinstance(query, dict):
+                raise ValueError("the query must be a json object")
+            if "reg_lesion" not in query and \
+                    not ("ct" in query and "mask" in query):
+                raise ValueError("supply `reg_lesion` or `ct` and `mask`")
+        except ValueError as err:
+            self.send_json(400, {"error": str(err)})
+            return
+
+        pool = self.server.pool
+        try:
+            out = pool.submit(disconnectome, query).result()
+        except BrokenProcessPool as err:
+            # a worker died (e.g. segfault or out of memory)
+            self.server.restart_pool(pool)
+            self.server.latency.add(time.time() - start, error=True)
+            self.send_json(500, {"error": repr(err)})
+            return
+        except Exception as err:
+            self.server.latency.add(time.time() - start, error=True)
+            self.send_json(500, {"error": repr(err)})
+            return
+        out["seconds"] = time.time() - start
+        self.server.latency.add(out["seconds"])
+        self.send_json(200, out)
+
+
+class PoolMixin:
+    '''
+    Process pool of the server, replaced if one of its workers dies
+    '''
+    def start_pool(self, make_pool):
+        self.make_pool = make_pool
+        self.pool_lock = threading.Lock()
+        self.pool = make_pool()
+
+    def restart_pool(self, broken):
+        with self.pool_lock:
+            # concurrent requests may all see the same broken pool
+            if self.pool is not broken:
+                return
+            print("a worker died, restarting the process pool")
+            broken.shutdown(wait=False)
+            self.pool = self.make_pool()
+
+
+class TCPServer(PoolMixin, ThreadingHTTPServer):
+    pass
+
+
+class UnixHTTPServer(PoolMixin, ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def serve(atlas_dir, port=8765, unix_socket=None, workers=2):
+    '''
+    Start the service on localhost:`port`, or on `unix_socket` if supplied.
+    Args:
+        `atlas_dir`: path to the directory containing the HCP-MMP atlas
+        `workers`: number of requests processed in parallel
+    '''
+    print("loading atlases and tractograms")
+    ref = warm_up(atlas_dir)
+
+    def make_pool():
+        # fork so the workers share the streamlines loaded above
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_worker, initargs=(atlas_dir, ref))
+        # with fork, every worker is started on the first submission; do it
+        # before any request is sent to the pool
+        pool.submit(int).result()
+        return pool
+
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, Handler)
+    else:
+        server = TCPServer(("127.0.0.1", port), Handler)
+    server.start_pool(make_pool)
+    server.latency = Latency()
+
+    print("listening on " + (unix_socket or "127.0.0.1:"+str(port)))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.pool.shutdown()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--atlas_dir', type=str, default="None")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", type=str, default=None)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+    if args.atlas_dir == "None":
+        atlas_dir = os.path.dirname(os.path.realpath(__file__)) + \
+            "/../atlas/"
+    else:
+        atlas_dir = args.atlas_dir
+
+    serve(atlas_dir, args.port, args.socket, args.workers)
@@ -0,0 +1,60 @@
+# SynthStrip brain extraction of many images in one process, so that Python,
+# PyTorch and the model weights are only loaded once.
+# Run with the interpreter of `mri_synthstrip` (see `preprocess.SynthStrip`):
+#     python synthstrip_worker.py /path/to/mri_synthstrip [--threads N]
+# Reads tab-separated `input output` pairs from stdin, one per line, and
+# answers each with `ok` or `error<TAB>message` on stdout.
+# Every image is processed by running the installed `mri_synthstrip` script
+# itself, so the output is the same as calling it. The modules it imports
+# stay loaded, and the checkpoint read by `torch.load` is kept in memory.
+import sys
+import argparse
+import contextlib
+
+
+def cached_load(load):
+    cache = {}
+
+    def wrapper(f, *args, **kwargs):
+        key = (str(f), repr(args), repr(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = load(f, *args, **kwargs)
+        return cache[key]
+    return wrapper
+
+
+def strip_one(code, script, in_path, save_path):
+    sys.argv = [script, "-i", in_path, "-o", save_path]
+    try:
+        # the script reports its progress on stdout, which is used to reply
+        with contextlib.redirect_stdout(sys.stderr):
+            exec(code, {"__name__": "__main__", "__file__": script})
+    except SystemExit as err:
+        if err.code not in [0, None]:
+            return "error\tmri_synthstrip exited with {}".format(err.code)
+    except Exception as err:
+        return "error\t" + repr(err)
+    return "ok"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script", type=str)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.script) as f:
+        code = compile(f.read(), args.script, "exec")
+
+    import torch
+    # the model is built again for every image, but the weights are only
+    # read from disk once
+    torch.load = cached_load(torch.load)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    for line in sys.stdin:
+        in_path, save_path = line.rstrip("\n").split("\t")
+        reply = strip_one(code, args.script, in_path, save_path)
+        sys.stdout.write(reply.replace("\n", " ") + "\n")
+        sys.stdout.flush()
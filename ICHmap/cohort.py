@@ -0,0 +1,283 @@
+# incremental cohort lesion frequency map and summary tables
+# Only new, changed or removed patients are read at each run; the running
+# state is kept in `state_dir`:
+#   state.json: image geometry and, for every patient and input file, its
+#   size, modification time and sha1
+#   count_<run>.npy: number of patients with a lesion at each voxel
+#   lesion/<ID>_<sha1>.npy: lesioned voxels of each patient, so it can be
+#   subtracted again when the patient changes or is removed
+#   lesion_load.csv, all_graph.csv, all_tract.csv: per-patient tables
+# state.json is replaced last and only refers to files of its own run, so an
+# interrupted update leaves the previous state usable.
+import re
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__))+"/../ICHcon")
+import atlas_cache as AC  # noqa: E402
+
+TABLES = {"lesion_load": ["ID", "Atlas", "Parcel", "Voxels"],
+          "all_graph": ["Metric", "Atlas", "Value", "ID"],
+          "all_tract": ["Tract", "Num", "ID"]}
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_changed(path, record):
+    '''
+    Compare `path` with its previous `record`. The content is only hashed if
+    the size or modification time differ, and `record` is updated in place.
+    Returns:
+        True if the content differs
+    '''
+    stat = os.stat(path)
+    if record.get("size") == stat.st_size and \
+            record.get("mtime") == stat.st_mtime:
+        return False
+    sha1 = file_sha1(path)
+    changed = record.get("sha1") != sha1
+    record.update({"size": stat.st_size, "mtime": stat.st_mtime,
+                   "sha1": sha1})
+    return changed
+
+
+def load_state(state_dir):
+    state = {"patients": {}, "shape": None, "affine": None, "run": 0,
+             "count": None, "tables": {}, "obsolete": [], "dir": state_dir}
+    if os.path.exists(state_dir+"/state.json"):
+        with open(state_dir+"/state.json") as f:
+            state.update(json.load(f))
+        if state["shape"] is not None:
+            state["count"] = np.load(
+                state_dir+"/count_{}.npy".format(state["run"]))
+
+    for key, columns in TABLES.items():
+        path = state_dir+"/"+key+".csv"
+        if os.path.exists(path):
+            # IDs such as 0012 must stay strings
+            state["tables"][key] = pd.read_csv(path, dtype={"ID": str},
+                                               keep_default_na=False)
+        else:
+            state["tables"][key] = pd.DataFrame(columns=columns)
+    return state
+
+
+def save_state(state, state_dir, changed=True):
+    '''
+    Args:
+        `changed`: if False, only the file records are saved
+    '''
+    os.makedirs(state_dir, exist_ok=True)
+    if changed:
+        for key, df in state["tables"].items():
+            path = state_dir+"/"+key+".csv"
+            df.to_csv(path+".tmp", index=False)
+            os.replace(path+".tmp", path)
+
+    if changed and state["count"] is not None:
+        state["obsolete"].append("count_{}.npy".format(state["run"]))
+        state["run"] += 1
+        np.save(state_dir+"/count_{}.npy".format(state["run"]),
+                state["count"])
+    meta = {i: state[i] for i in ["patients", "shape", "affine", "run"]}
+    with open(state_dir+"/state.json.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(state_dir+"/state.json.tmp", state_dir+"/state.json")
+
+    for i in state["obsolete"]:
+        if os.path.exists(state_dir+"/"+i):
+            os.remove(state_dir+"/"+i)
+    state["obsolete"] = []
+
+
+def drop_rows(state, key, ID):
+    df = state["tables"][key]
+    state["tables"][key] = df[df["ID"] != ID]
+
+
+def add_rows(state, key, df):
+    if len(df) > 0:
+        state["tables"][key] = pd.concat([state["tables"][key], df],
+                                         ignore_index=True)
+
+
+def lesion_load(index, atlas_dir, ID):
+    '''
+    Number of lesioned voxels in each parcel of every atlas
+    Args:
+        `index`: flat indices of the lesioned voxels
+    '''
+    all_df = []
+    for i in AC.ATLAS:
+        mask_path = atlas_dir+"/"+i+".nii.gz"
+        labels = AC.load_volume(mask_path).reshape(-1)
+        vox = np.bincount(labels[index],
+                          minlength=AC.load_meta(mask_path)["max"]+1)[1:]
+        all_df.append(pd.DataFrame({"ID": ID, "Atlas": i,
+                                    "Parcel": AC.load_parcel(mask_path),
+                                    "Voxels": vox}))
+    return pd.concat(all_df, axis=0, ignore_index=True)
+
+
+def remove_lesion(state, ID, record):
+    if "index" in record:
+        index_path = record.pop("index")
+        state["count"].reshape(-1)[np.load(state["dir"]+"/"+index_path)] -= 1
+        state["obsolete"].append(index_path)
+    drop_rows(state, "lesion_load", ID)
+
+
+def add_lesion(state, ID, record, img_path, atlas_dir=None):
+    img = nib.load(img_path)
+    if state["count"] is None:
+        state["shape"] = list(img.shape)
+        state["affine"] = img.affine.tolist()
+        state["count"] = np.zeros(img.shape, dtype=np.uint32)
+    if list(img.shape) != state["shape"]:
+        print("cannot add "+ID+": image shape differs from the cohort")
+        return False
+
+    index = np.flatnonzero(np.asanyarray(img.dataobj) > 0)
+    state["count"].reshape(-1)[index] += 1
+    record["index"] = "lesion/"+ID+"_"+record["sha1"][:12]+".npy"
+    os.makedirs(state["dir"]+"/lesion", exist_ok=True)
+    np.save(state["dir"]+"/"+record["index"], index.astype(np.int64))
+    if atlas_dir is not None:
+        add_rows(state, "lesion_load", lesion_load(index, atlas_dir, ID))
+    return True
+
+
+def read_graph(path, ID):
+    # same as `summary.R`
+    df = pd.read_csv(path, keep_default_na=False)
+    df = df[df["measure"] == "count"]
+    df = df.rename(columns={df.columns[0]: "Metric", "unnormalized": "Value",
+                            "atlas": "Atlas"})
+    df = df[["Metric", "Atlas", "Value"]].copy()
+    df["ID"] = ID
+    return df
+
+
+def read_tract(path, ID):
+    # same as `summary.R`
+    df = pd.read_csv(path, keep_default_na=False)
+    df = df.rename(columns={df.columns[0]: "Tract", "num": "Num"})
+    df["Tract"] = df["Tract"].str.replace(".trk", "", regex=False)
+    df["ID"] = ID
+    return df[["Tract", "Num", "ID"]]
+
+
+def update(state_dir, lesion_dir=None, connectome_dir=None, atlas_dir=None):
+    '''
+    Fold new or changed patients into the running state and remove the
+    patients that no longer exist
+    Args:
+        `state_dir`: where the running state is kept
+        `lesion_dir`: registered lesions, named `ID.nii.gz`
+        `connectome_dir`: output of `lesion.py`, one folder per patient
+        `atlas_dir`: if supplied, track the lesion load of every parcel
+    Returns:
+        the updated state
+    '''
+    state = load_state(state_dir)
+    patients = state["patients"]
+
+    inputs = {}
+    if lesion_dir is not None:
+        for i in sorted(os.listdir(lesion_dir)):
+            if i.endswith(".nii.gz"):
+                ID = re.sub(".nii.gz$", "", i)
+                inputs.setdefault(ID, {})["lesion"] = lesion_dir+"/"+i
+    if connectome_dir is not None:
+        for ID in sorted(os.listdir(connectome_dir)):
+            graph = connectome_dir+"/"+ID+"/graph_metrics.csv"
+            tract = connectome_dir+"/"+ID+"/metric/tract_num.csv"
+            if os.path.exists(graph):
+                inputs.setdefault(ID, {})["graph"] = graph
+            if os.path.exists(tract):
+                inputs.setdefault(ID, {})["tract"] = tract
+
+    num_changed = 0
+    for ID in sorted(set(patients) | set(inputs)):
+        record = patients.setdefault(ID, {})
+        paths = inputs.get(ID, {})
+        for key in ["lesion", "graph", "tract"]:
+            if key not in paths:
+                # removed patient or file
+                if key in record:
+                    num_changed += 1
+                    if key == "lesion":
+                        remove_lesion(state, ID, record[key])
+                    else:
+                        drop_rows(state, "all_"+key, ID)
+                    del record[key]
+                continue
+
+            record.setdefault(key, {})
+            if not file_changed(paths[key], record[key]):
+                continue
+            num_changed += 1
+            if key == "lesion":
+                remove_lesion(state, ID, record[key])
+                if not add_lesion(state, ID, record[key], paths[key],
+                                  atlas_dir):
+                    del record[key]
+            elif key == "graph":
+                drop_rows(state, "all_graph", ID)
+                add_rows(state, "all_graph", read_graph(paths[key], ID))
+            else:
+                drop_rows(state, "all_tract", ID)
+                add_rows(state, "all_tract", read_tract(paths[key], ID))
+        if len(record) == 0:
+            del patients[ID]
+
+    print("{} patients, {} files updated".format(len(patients), num_changed))
+    save_state(state, state_dir, num_changed > 0)
+    return state
+
+
+def emit(state, save_dir):
+    '''
+    Write the lesion frequency map and the summary tables from the state
+    '''
+    os.makedirs(save_dir, exist_ok=True)
+    if state["count"] is not None:
+        img = nib.Nifti1Image(state["count"].astype(np.int32),
+                              np.array(state["affine"]))
+        img.to_filename(save_dir+"/freq_map.nii.gz")
+
+    for key, df in state["tables"].items():
+        df.to_csv(save_dir+"/"+key+".csv", index=False)
+    load = state["tables"]["lesion_load"]
+    if len(load) > 0:
+        # `Patients`: number of patients with a lesion in the parcel
+        total = load.assign(Patients=load["Voxels"] > 0)
+        total = total.groupby(["Atlas", "Parcel"], sort=False)
+        total = total[["Voxels", "Patients"]].sum().reset_index()
+        total.to_csv(save_dir+"/lesion_load_total.csv", index=False)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--state_dir', type=str)
+    parser.add_argument('--save_dir', type=str)
+    parser.add_argument('--lesion_dir', type=str, default=None)
+    parser.add_argument('--connectome_dir', type=str, default=None)
+    parser.add_argument('--atlas_dir', type=str, default=None)
+    args = parser.parse_args()
+
+    state = update(args.state_dir, args.lesion_dir, args.connectome_dir,
+                   args.atlas_dir)
+    emit(state, args.save_dir)
@@ -27,13 +27,16 @@ export FREESURFER_HOME=/opt/.synthstrip/
 export PATH=$PATH:$FREESURFER_HOME/bin
 export PATH=$PATH:/opt/.fsl
 export PATH=$PATH:/opt/.julia/bin
+# the atlas folder is read-only inside the container
+export ICHMAP_CACHE=/opt/data/.atlas_cache
 
 # step 1: skullstripping
 conda activate ich
 python ICHcon/preprocess.py --ct_dir=data/ct \
     --save_dir=data/skullstripped \
     --num=$num_jobs \
-    --arrayID=$arrayID
+    --arrayID=$arrayID \
+    --strip_threads=$num_cpu
 conda deactivate
 
 # step 2: ICH segmentation
@@ -68,7 +71,12 @@ python ICHcon/lesion.py --ct_dir=data/skullstripped \
 # step 5: summary statistics
 if [ $arrayID == 0 ]
 then
-    Rscript ICHmap/summary.R data/connectome data/stats
+    # only new, changed or removed patients are read again
+    python ICHmap/cohort.py --state_dir=data/stats/cohort \
+        --lesion_dir=data/reg_lesion \
+        --connectome_dir=data/connectome \
+        --atlas_dir=atlas \
+        --save_dir=data/stats
     python ICHmap/sum_vol.py --img_dir=data/mask \
         --save_path=data/stats/vol.csv
 fi
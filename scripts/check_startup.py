@@ -0,0 +1,72 @@
+# check the import time of the ICHcon entry points with `python -X importtime`
+# usage: python scripts/check_startup.py [--scale 2]
+import os
+import sys
+import subprocess
+
+root = os.path.dirname(os.path.realpath(__file__))+"/../"
+
+# module: (directory, budget in seconds)
+ENTRY = {"preprocess": ("ICHcon", 1.5),
+         "register": ("ICHcon", 1.5),
+         "lesion": ("ICHcon", 2.),
+         "conn_metric": ("ICHcon", 2.),
+         "atlas_cache": ("ICHcon", 1.5),
+         "server": ("ICHcon", 2.),
+         "sum_vol": ("ICHmap", 1.5),
+         "cohort": ("ICHmap", 1.5)}
+
+# packages that must only be imported by the functions using them
+HEAVY = ["ants", "SimpleITK", "skimage", "fsl", "dipy", "torch"]
+
+
+def import_time(module, path):
+    '''
+    Returns:
+        cumulative import time of `module` in seconds
+        set of top-level packages imported along with it
+    '''
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                          "import "+module], cwd=path, capture_output=True,
+                         text=True)
+    if out.returncode != 0:
+        raise ImportError(out.stderr.splitlines()[-1])
+
+    total, packages = 0, set()
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        packages.add(name.strip().split(".")[0])
+        if name.strip() == module:
+            total = int(cumulative)/1e6
+    return total, packages
+
+
+def check_all(scale=1.):
+    failed = []
+    for module, (path, budget) in ENTRY.items():
+        try:
+            total, packages = import_time(module, root+path)
+        except ImportError as err:
+            print("{:<12} cannot be imported: {}".format(module, err))
+            failed.append(module)
+            continue
+
+        heavy = sorted(set(HEAVY) & packages)
+        ok = total <= budget*scale and len(heavy) == 0
+        print("{:<12} {:6.2f}s / {:4.1f}s {} {}".format(
+            module, total, budget*scale, "ok" if ok else "FAIL",
+            ", ".join(heavy)))
+        if not ok:
+            failed.append(module)
+    return failed
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=1.,
+                        help="multiply every budget, e.g. on slow file systems")
+    args = parser.parse_args()
+    sys.exit(1 if len(check_all(args.scale)) > 0 else 0)